@@ -0,0 +1,249 @@
+#!/usr/bin/python
+"""Benchmarks of botko's hot paths.
+
+Usage: python benchmark.py [TRAFFIC_FILE] [-k NAME] [--save BASELINE]
+                           [--compare BASELINE] [--threshold PERCENT]
+
+TRAFFIC_FILE holds raw IRC lines as received from a server, one per
+line. A botko debug log (botko.py -vv) works too; only its 'RX bytes: '
+lines are used. Without a file, a small built-in sample of freenode
+traffic is used.
+
+Each benchmark reports the best time per operation, in microseconds.
+--save stores the results as a JSON baseline; --compare reports each
+result relative to a stored baseline, flags those slower by more than
+--threshold percent, and exits with status 1 if there are any.
+"""
+
+import os
+import sys
+import json
+import time
+import timeit
+import logging
+import argparse
+import platform
+import tempfile
+from collections import OrderedDict
+from datetime import datetime
+
+import irc
+
+SAMPLE_TRAFFIC = (
+    ':card.freenode.net NOTICE * :*** Looking up your hostname...',
+    ':card.freenode.net 001 botko :Welcome to the freenode Internet Relay Chat Network botko',
+    ':card.freenode.net 005 botko CHANTYPES=# EXCEPTS INVEX CHANMODES=eIbq,k,flj,CFLMPQScgimnprstz CHANLIMIT=#:120 PREFIX=(ov)@+ MAXLIST=bqeI:100 MODES=4 NETWORK=freenode STATUSMSG=@+ CALLERID=g CASEMAPPING=rfc1459 :are supported by this server',
+    ':card.freenode.net 005 botko CHARSET=ascii NICKLEN=16 CHANNELLEN=50 TOPICLEN=390 DEAF=D FNC TARGMAX=NAMES:1,LIST:1,KICK:1,WHOIS:1,PRIVMSG:4,NOTICE:4,ACCEPT:,MONITOR: EXTBAN=$,ajrxz CLIENTVER=3.0 :are supported by this server',
+    ':card.freenode.net 372 botko :- Thank you for using freenode!',
+    ':botko!~botko@193.77.101.39 JOIN #python',
+    ':card.freenode.net 353 botko @ #python :botko dash @ChanServ kernc Smotko edofic +lamefun',
+    ':card.freenode.net 366 botko #python :End of /NAMES list.',
+    'PING :card.freenode.net',
+    ':HairyFodder!~Xatic@isp.example.com PRIVMSG #python :some1 speak python here?',
+    ':Smotko!~smotko@unaffiliated/smotko PRIVMSG #python :have a look at https://docs.python.org/3/library/asyncio.html',
+    ':kernc!~kernc@gateway/shell/example.org/x-qwerty PRIVMSG #python :\x01ACTION slaps Smotko around a bit with a large trout\x01',
+    ':edofic!~edofic@89-212-114-12.dynamic.t-2.net PRIVMSG botko :\x01VERSION\x01',
+    ':lamefun!~lamefun@cpc1-brig1-2-0-cust123.3-3.cable.virginm.net PART #python :"Leaving"',
+    ':dash!~dash@2001:1470:fffd:98:5ca3:1e4b:62b0:aa7 QUIT :Ping timeout: 260 seconds',
+    ':ChanServ!ChanServ@services. MODE #python +o kernc',
+    ':NickServ!NickServ@services. NOTICE botko :This nickname is registered.',
+    ':Smotko!~smotko@unaffiliated/smotko NICK :Smotko_away',
+    ':kernc!~kernc@gateway/shell/example.org/x-qwerty TOPIC #python :Python programming language | Paste code at https://bpaste.net',
+    ':HairyFodder!~Xatic@isp.example.com PRIVMSG #python :anyone? :)',
+)
+
+def read_traffic(filename):
+    marker = 'RX bytes: '
+    with open(filename) as f:
+        lines = [line.rstrip('\r\n') for line in f]
+    if any(marker in line for line in lines):
+        lines = [line.split(marker, 1)[1] for line in lines if marker in line]
+    return [line for line in lines if line]
+
+BENCHMARKS = OrderedDict()  # name -> function(lines), returning {result name: us/op}
+
+def benchmark(func):
+    """Registers func as a benchmark"""
+    BENCHMARKS[func.__name__[len('bench_'):]] = func
+    return func
+
+def bench(func, lines, repeat=5):
+    """Returns best time per line, in microseconds"""
+    number = max(1, 100000 // len(lines))
+    timer = timeit.Timer(lambda: [func(line) for line in lines])
+    return min(timer.repeat(repeat, number)) / number / len(lines) * 1e6
+
+def bench_call(func, number, repeat=5):
+    """Returns best time per func() call, in microseconds"""
+    return min(timeit.Timer(func).repeat(repeat, number)) / number * 1e6
+
+def quiet_bot():
+    """Returns a botko.Bot with no plugins loaded and no connection"""
+    import botko
+    plugins = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plugins')
+    config = {os.path.splitext(filename)[0]: {'disabled': '1'}
+              for filename in os.listdir(plugins) if filename.endswith('.py')}
+    config['main'] = {'nickname': 'botko', 'channels': '#botko'}
+    return botko.Bot(config)
+
+@benchmark
+def bench_parse_line(lines):
+    logging.disable(logging.ERROR)  # strict parser logs each rejected line
+    valid = [line for line in lines if irc.parse_line(line, strict=True)]
+    logging.disable(logging.NOTSET)
+    if len(valid) < len(lines):
+        print('{} lines rejected by strict parser (e.g. cloaked hosts)'.format(
+              len(lines) - len(valid)))
+    for line in valid:
+        if irc.parse_line(line) != irc.parse_line(line, strict=True):
+            print('Parsers disagree on line:', repr(line))
+    return OrderedDict((
+        ('parse_line[strict]', bench(lambda line: irc.parse_line(line, strict=True), valid)),
+        ('parse_line', bench(irc.parse_line, lines)),
+        ('parse_line[bytes]', bench(irc.parse_line, [line.encode('utf-8') for line in lines])),
+    ))
+
+@benchmark
+def bench_parse_lines(lines):
+    buffer = b''.join(line.encode('utf-8') + b'\r\n' for line in lines)
+    buffer *= max(1, 200000 // len(lines))
+    started = time.perf_counter()
+    count = sum(1 for _ in irc.parse_lines(buffer))
+    return {'parse_lines': (time.perf_counter() - started) / count * 1e6}
+
+@benchmark
+def bench_config(lines):
+    from botko import Config, DEFAULT_CONFIG
+    config = Config(DEFAULT_CONFIG)
+    config['reposts'] = {'channels': '#botko'}
+    return OrderedDict((
+        ('Config.get', bench_call(lambda: config.get('reposts/channels'), 100000)),
+        ('Config.get[missing]', bench_call(lambda: config.get('logger/channels', None), 100000)),
+    ))
+
+@benchmark
+def bench_dispatch(lines):
+    bot = quiet_bot()
+    for _ in range(3): bot.add_handler('on_privmsg', lambda bot, message: None)
+    message = irc.parse_line(':kernc!~kernc@example.org PRIVMSG botko :hello')
+    raw = [line.encode('utf-8') for line in lines]
+    return OrderedDict((
+        ('trigger_event[3 handlers]', bench_call(lambda: bot._trigger_event('privmsg', message), 100000)),
+        ('trigger_event[no handlers]', bench_call(lambda: bot._trigger_event('part', message), 100000)),
+        ('process_line', bench(bot._process_line, raw)),
+    ))
+
+@benchmark
+def bench_reply_queue(lines):
+    from botko import ProtocolReplyEventQueue
+    replies = ProtocolReplyEventQueue()
+    def waiter():
+        while True: yield (yield)
+    def expect_fulfil():
+        coroutine = waiter(); next(coroutine)
+        replies.expect(coroutine, irc.REPLIES_JOIN)
+        replies.fulfil(irc.RPL_ENDOFNAMES)
+    return {'expect+fulfil': bench_call(expect_fulfil, 20000)}
+
+@benchmark
+def bench_reposts(lines):
+    from plugins import reposts
+    texts = [irc.parse_line(line).text or '' for line in lines]
+    assert all(reposts.find_links(text) == [match.group() for match in reposts.link_re.finditer(text)]
+               for text in texts)
+    plain = [text for text in texts if not reposts.link_re.search(text)]
+    linked = [text for text in texts if reposts.link_re.search(text)] or ['see https://example.com/']
+    words = ' '.join(plain).split()
+    plain = [' '.join(words[i:i + 12]) for i in range(0, len(words), 12)]  # chattier lines
+    chat = (plain * 1000)[:990] + (linked * 10)[:10]  # realistically, 1% with links
+    contains = reposts.on_chanmsg.contains
+    def prefiltered(text):  # as FilteredHandlers.select does first
+        lowered = text.lower()
+        for part in contains:
+            if part in lowered: return reposts.find_links(text)
+    history = reposts.LinkHistory(1000)
+    links = ['https://example.com/{}'.format(i) for i in range(2000)]
+    def post(link):  # over maxlen, each new link evicts the least recent
+        history[link] = ('kernc', 0, 1)
+    store = reposts.SqliteStore(os.path.join(tempfile.mkdtemp(prefix='botko-benchmark-'), 'reposts.sqlite'))
+    for link in links[:100]: store.set('#botko', link, ('kernc', datetime.now(), 1))
+    new_links = ['https://example.org/{}'.format(i) for i in range(1000)]
+    return OrderedDict((
+        ('link_re.findall', bench(reposts.link_re.findall, texts)),
+        ('find_links', bench(reposts.find_links, texts)),
+        ('link_re.findall[1% links]', bench(reposts.link_re.findall, chat)),
+        ('contains+find_links[1% links]', bench(prefiltered, chat)),
+        ('normalize_link', bench(reposts.normalize_link, links)),
+        ('LinkHistory[link] = ...', bench(post, links)),
+        ('SqliteStore.get[new link]', bench(lambda link: store.get('#botko', link), new_links)),
+        ('SqliteStore.get[posted link]', bench(lambda link: store.get('#botko', link), links[:100])),
+    ))
+
+@benchmark
+def bench_serializer(lines):
+    from plugins import serializer
+    serializer.data_dir = tempfile.mkdtemp(prefix='botko-benchmark-') + os.sep
+    data = {'#botko': OrderedDict(('https://example.com/{}'.format(i), ('kernc', i, 1))
+                                  for i in range(1000))}
+    plain = {channel: dict(links) for channel, links in data.items()}
+    results = OrderedDict()
+    for name, dump, load, value in (('pickle', serializer.pickle_dump, serializer.pickle_load, data),
+                                    ('marshal', serializer.marshal_dump, serializer.marshal_load, plain)):
+        results[name + '_dump[1000 links]'] = bench_call(lambda: dump('benchmark', value), 20)
+        results[name + '_load[1000 links]'] = bench_call(lambda: load('benchmark'), 20)
+    return results
+
+def compare(results, baseline, threshold):
+    """Prints results relative to baseline; returns names of those
+    slower by more than threshold percent"""
+    regressions = []
+    for name, us in results.items():
+        if name not in baseline:
+            print('{:32} {:10.3f} us   (no baseline)'.format(name, us))
+            continue
+        change = (us / baseline[name] - 1) * 100
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('{:32} {:10.3f} us  {:+6.1f}%{}'.format(name, us, change, flag))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('traffic', nargs='?', metavar='TRAFFIC_FILE')
+    parser.add_argument('-k', dest='only', action='append', choices=list(BENCHMARKS),
+                        help='run only this benchmark (repeatable)')
+    parser.add_argument('--save', metavar='BASELINE', help='save results as JSON')
+    parser.add_argument('--compare', metavar='BASELINE', help='compare with saved results')
+    parser.add_argument('--threshold', type=float, default=10, metavar='PERCENT',
+                        help='slowdown flagged as a regression (default: %(default)s)')
+    args = parser.parse_args()
+    lines = read_traffic(args.traffic) if args.traffic else SAMPLE_TRAFFIC
+    print('Benchmarking on {} lines of traffic'.format(len(lines)))
+    results = OrderedDict()
+    for name, func in BENCHMARKS.items():
+        if args.only and name not in args.only: continue
+        results.update(func(lines))
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+    else:
+        regressions = ()
+        for name, us in results.items():
+            print('{:32} {:10.3f} us'.format(name, us))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'created': time.time(),
+                       'results': results}, f, indent=1)
+        print('Saved baseline to', args.save)
+    if regressions:
+        print('{} regression(s) over {}%'.format(len(regressions), args.threshold))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,25 @@
 #!/usr/bin/python -OO
 
 import re
+import sys
 import time
+import heapq
+import random
+import asyncio
+import inspect
 import logging
-import asynchat
 from os import path
-from datetime import datetime
-from threading import Thread, Lock
+from threading import Lock, get_ident
 from functools import partial, update_wrapper
-from collections import defaultdict, Mapping
+from difflib import get_close_matches
+from itertools import count
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict, deque, OrderedDict
+from collections.abc import Sequence
 
 import irc
+from metrics import Metrics
+from profiler import Profiler, handler_key
 
 try: bytes('test', 'utf-8')
 except TypeError: pass
@@ -29,6 +38,16 @@ DEFAULT_CONFIG = {
         'server': 'chat.freenode.net',
         'port': '6667',
         'data_dir': './data/',  # TODO: allow env var interpolation, e.g. $HOME/... ?
+        'fallback_encoding': 'latin-1',
+        'flood_burst': '5',  # lines
+        'flood_rate': '0.5',  # lines per second
+        'workers': '4',  # threads for __blocking__ plugin handlers
+        'worker_backlog': '1000',  # handler calls waiting for a thread
+        'handler_timeout': '30',  # seconds
+        'reply_timeout': '60',  # seconds to wait for an expect()ed reply
+        'profile_interval': '',  # seconds between handler profile dumps; off if empty
+        'metrics_interval': '',  # seconds between writes of data_dir/botko.prom; off if empty
+        'metrics_port': '',  # serve metrics on this local port; off if empty
     }
 }
 LINE_TERMINATOR = b'\r\n'
@@ -96,75 +115,774 @@ def synchronized(lock):
         return decorated
     return wrapper
 
-class PeriodicExecutor(Thread):
-    def __init__(self, name, seconds, func, args=(), kwargs={}):
-        super(self.__class__, self).__init__(name=name)
-        self.func = partial(func, *args, **kwargs)
-        self.seconds = seconds
-        self.daemon = True
-    def __call__(self, *args):
-        self.run()
-    def run(self):
+class Timer(object):
+    """A callback scheduled with Scheduler"""
+    __slots__ = ('func', 'due', 'base', 'interval', 'jitter', 'cancelled')
+
+    def __init__(self, func, base, interval=None, jitter=0):
+        self.func = func
+        self.base = base  # due time, without jitter
+        self.due = base + random.uniform(0, jitter)
+        self.interval, self.jitter = interval, jitter
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class Scheduler(object):
+    """Runs one-shot and periodic callbacks on the event loop.
+
+    All timers are kept in one heap, and only the earliest one has a
+    handle on the event loop. Periodic callbacks are due at fixed
+    multiples of their interval from when they were scheduled, so they
+    don't drift however long they run; if one falls behind by whole
+    intervals, the missed calls are skipped. Timers can be added from
+    any thread, also before start().
+
+    >>> scheduler = Scheduler()
+    >>> timer = scheduler.call_every(60, print, 'tick', jitter=5)
+    >>> len(scheduler), 0 <= timer.due - timer.base <= 5
+    (1, True)
+
+    A call that fell behind runs once and is next due on its schedule,
+    and a timer added by a callback leaves one handle on the loop:
+
+    >>> timer.cancel(); loop = asyncio.new_event_loop(); scheduler.start(loop)
+    >>> timer = scheduler._push(Timer(partial(print, 'tick'), time.monotonic() - 150, 60))
+    >>> _ = scheduler.call_later(0, scheduler.call_later, 10, print, 'later')
+    >>> loop.run_until_complete(asyncio.sleep(.05))
+    tick
+    >>> 0 < timer.base - time.monotonic() <= 30, len(scheduler)
+    (True, 3)
+    >>> sum(not handle.cancelled() for handle in loop._scheduled)
+    1
+    >>> never = scheduler.call_later(0, print, 'never'); never.cancel()
+    >>> loop.run_until_complete(asyncio.sleep(.05)); len(scheduler)
+    3
+    >>> timer.cancel(); loop.close()
+    """
+    def __init__(self):
+        self.loop = None
+        self._loop_thread = None
+        self._lock = Lock()
+        self._heap = []  # (due, seq, Timer)
+        self._seq = count()  # tie-breaker for equal due times
+        self._handle = None  # event loop TimerHandle for the earliest timer
+        self.profiler = None  # a Profiler, to time the callbacks
+
+    def __len__(self):
+        return len(self._heap)
+
+    def start(self, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self._loop_thread = get_ident()
+        self._arm()
+
+    def call_later(self, delay, func, *args):
+        """Calls func(*args) once, after delay seconds; returns Timer"""
+        return self._push(Timer(partial(func, *args), time.monotonic() + delay))
+
+    def call_every(self, interval, func, *args, jitter=0):
+        """Calls func(*args) every interval seconds, each time delayed by
+        a random 0 to jitter seconds, until it returns a true value or the
+        returned Timer is cancelled"""
+        return self._push(Timer(partial(func, *args), time.monotonic() + interval,
+                                interval, jitter))
+
+    def _push(self, timer):
+        with self._lock:
+            heapq.heappush(self._heap, (timer.due, next(self._seq), timer))
+            earliest = self._heap[0][2] is timer
+        if earliest and self.loop is not None:
+            if get_ident() == self._loop_thread: self._arm()
+            else: self.loop.call_soon_threadsafe(self._arm)
+        return timer
+
+    def _arm(self):
+        if self._handle is not None: self._handle.cancel()
+        with self._lock:
+            due = self._heap[0][0] if self._heap else None
+        self._handle = None if due is None else self.loop.call_later(
+            max(0, due - time.monotonic()), self._run_due)
+
+    def _run_due(self):
+        self._handle = None  # has run; the _arm() below cancels any armed meanwhile
+        now = time.monotonic()
         while True:
-            time.sleep(self.seconds)
-            if self.func(): break
+            with self._lock:
+                if not self._heap or self._heap[0][0] > now: break
+                timer = heapq.heappop(self._heap)[2]
+            if timer.cancelled: continue
+            profiler = self.profiler
+            try:
+                done = (timer.func() if profiler is None else
+                        profiler.call(handler_key(timer.func), timer.func))
+            except Exception:
+                log.exception('Error in timed callback {}'.format(timer.func))
+                done = False
+            if timer.interval and not done and not timer.cancelled:
+                timer.base += timer.interval
+                if timer.base <= now:  # fell behind; skip missed calls
+                    timer.base += ((now - timer.base) // timer.interval + 1) * timer.interval
+                timer.due = timer.base + random.uniform(0, timer.jitter)
+                with self._lock:
+                    heapq.heappush(self._heap, (timer.due, next(self._seq), timer))
+        self._arm()
+
+class WorkerPool(object):
+    """Runs blocking handlers in a thread pool, off the event loop.
 
-class Connection(asynchat.async_chat):
-    buffer = []
-    def collect_incoming_data(self, data):
-        self.buffer.append(data)
+    Calls submitted under the same key (a plugin name) run one at a
+    time, in the order submitted. A call that runs longer than its
+    timeout is logged and abandoned (a thread can't be killed), and the
+    next call for its key starts without it. Once backlog calls are
+    pending, further ones are dropped.
+
+    >>> pool = WorkerPool(workers=1, backlog=1)
+    >>> pool.submit('plugin', 0, time.sleep, .1), pool.submit('plugin', 0, print)
+    (True, False)
+    >>> pool.shutdown(wait=True); pool.pending, pool.dropped
+    (0, 1)
+    """
+    def __init__(self, workers=4, backlog=1000, call_later=None):
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='botko-worker')
+        self._call_later = call_later  # e.g. Scheduler.call_later, for timeouts
+        self._lock = Lock()
+        self._queues = {}  # key -> deque of pending (timeout, func, args)
+        self._running = {}  # key -> token of its current call
+        self.backlog = backlog
+        self.pending = self.dropped = self.timeouts = 0
+        self.profiler = None  # a Profiler, to time the calls
+
+    def submit(self, key, timeout, func, *args):
+        """Queues func(*args) after key's earlier calls; returns False
+        if it was dropped because the backlog is full"""
+        with self._lock:
+            if self.pending >= self.backlog:
+                self.dropped += 1
+                log.warning('Worker backlog full, dropping call to {}'.format(func))
+                return False
+            self.pending += 1
+            self._queues.setdefault(key, deque()).append((timeout, func, args))
+            if key not in self._running: self._start_next(key)
+        return True
+
+    def shutdown(self, wait=False):
+        self._executor.shutdown(wait)
+
+    def _start_next(self, key):  # with self._lock held
+        queue = self._queues.get(key)
+        if not queue:
+            self._queues.pop(key, None)
+            self._running.pop(key, None)
+            return
+        timeout, func, args = queue.popleft()
+        token = [None]  # identifies this call; holds its timeout Timer
+        self._running[key] = token
+        if timeout and self._call_later is not None:
+            token[0] = self._call_later(timeout, self._timed_out, key, token, func)
+        self._executor.submit(self._run, key, token, func, args)
+
+    def _run(self, key, token, func, args):
+        profiler = self.profiler
+        try:
+            if profiler is None: func(*args)
+            else: profiler.call(handler_key(func, func.__name__ + '[worker]'), func, *args)
+        except Exception: log.exception('Error in blocking handler {}'.format(func))
+        finally:
+            if token[0] is not None: token[0].cancel()
+            with self._lock:
+                self.pending -= 1
+                if self._running.get(key) is token: self._start_next(key)
+
+    def _timed_out(self, key, token, func):
+        with self._lock:
+            if self._running.get(key) is not token: return  # already done
+            self.timeouts += 1
+            log.warning('Blocking handler {} timed out, abandoning it'.format(func))
+            self._start_next(key)
+
+class Connection(asyncio.BufferedProtocol):
+    """Line-based client connection running on an asyncio event loop.
+
+    Data is received straight into this connection's own bytearray
+    buffer. Each read is scanned for LINE_TERMINATOR once, and every
+    complete line is passed to the callback set with set_line_handler()
+    as a memoryview slice of the buffer, which is only valid during the
+    call. If the callback returns an awaitable, it is run as a task.
+    While the socket's write buffer is above its high-water mark,
+    reading is paused. Many connections can run on the same event loop.
+
+    Lines and their terminators can be split across reads:
+
+    >>> connection = Connection()
+    >>> connection.set_line_handler(lambda line: print(line.tobytes()))
+    >>> def receive(data):  # as the event loop does
+    ...     while data:
+    ...         buffer = connection.get_buffer(-1)
+    ...         n = min(len(buffer), len(data))
+    ...         buffer[:n], data = data[:n], data[n:]
+    ...         connection.buffer_updated(n)
+    >>> receive(b'PING :a\\r'); receive(b'\\nPI'); receive(b'NG :b\\r\\nPING :c\\r\\nPI')
+    b'PING :a'
+    b'PING :b'
+    b'PING :c'
+    >>> receive(b'NG :d\\r\\n')
+    b'PING :d'
+
+    Lines longer than buffer_size are dropped whole:
+
+    >>> Connection.buffer_size, buffer_size = 16, Connection.buffer_size
+    >>> connection = Connection(); Connection.buffer_size = buffer_size
+    >>> connection.set_line_handler(lambda line: print(line.tobytes()))
+    >>> receive(b'PRIVMSG #a :' + b'x' * 20 + b'\\r\\nPING :e\\r\\n')
+    b'PING :e'
+    """
+    buffer_size = 64 * 1024  # longer lines are discarded
+
+    def __init__(self):
+        self.loop = None
+        self._transport = None
+        self._loop_thread = None
+        self._line_handler = None
+        self._closed = None  # future, done when disconnected
+        self._buffer = bytearray(self.buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = self._end = 0  # unprocessed data is _buffer[_start:_end]
+        self._discarding = False  # skipping the rest of an overlong line
 
     def set_line_handler(self, callback):
-        def found_terminator():
-            line = self.buffer[0] if len(self.buffer) == 1 else b''.join(self.buffer)
-            del self.buffer[:]
-            callback(line)
-        self.found_terminator = found_terminator
-
-    def handle_error(self):
-        excepthook()
-    def handle_close(self):  # FIXME: this doesn't get run. problem?
+        self._line_handler = callback
+
+    def handle_connect(self):
+        """Called when the connection is established"""
+    def handle_close(self):
         log.info('Closing...')
 
-expect_lock = Lock()
+    async def run(self, host, port):
+        """Connects to host:port and handles lines until disconnected"""
+        self.loop = asyncio.get_event_loop()
+        self._loop_thread = get_ident()
+        self._closed = self.loop.create_future()
+        await self.loop.create_connection(lambda: self, host, port)
+        await asyncio.shield(self._closed)
+
+    def push(self, data):
+        """Sends data. Safe to call from any thread."""
+        if self._transport is None:
+            log.error('Not connected; dropping: {!r}'.format(data))
+        elif get_ident() == self._loop_thread:
+            self._transport.write(data)
+        else:
+            self.loop.call_soon_threadsafe(self._transport.write, data)
+
+    def close(self):
+        if self._transport is not None and not self._transport.is_closing():
+            self._transport.close()
+
+    async def wait_closed(self):
+        if self._closed is not None:
+            try: await self._closed
+            except Exception: pass
+
+    # asyncio.BufferedProtocol callbacks
+    def connection_made(self, transport):
+        self._transport = transport
+        self.handle_connect()
+
+    def connection_lost(self, exc):
+        if exc is not None: log.error('Connection lost: {}'.format(exc))
+        self.handle_close()
+        if not self._closed.done(): self._closed.set_result(None)
+
+    def pause_writing(self):
+        self._transport.pause_reading()
+    def resume_writing(self):
+        self._transport.resume_reading()
+
+    def get_buffer(self, sizehint):
+        if self._end == len(self._buffer):  # full; make room
+            if self._start == 0:
+                if not self._discarding:
+                    log.warning('Discarding line longer than {} bytes'.format(self._end))
+                self._discarding = True
+                self._start = self._end - len(LINE_TERMINATOR) + 1  # keep split terminator
+            # move the incomplete line to the front
+            length = self._end - self._start
+            self._buffer[:length] = self._view[self._start:self._end].tobytes()
+            self._start, self._end = 0, length
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes):
+        buffer, view, handler = self._buffer, self._view, self._line_handler
+        start = self._start
+        scan = max(start, self._end - len(LINE_TERMINATOR) + 1)
+        self._end = end_of_data = self._end + nbytes
+        try:
+            while True:
+                end = buffer.find(LINE_TERMINATOR, scan, end_of_data)
+                if end < 0: break
+                if self._discarding:
+                    self._discarding = False
+                else:
+                    result = handler(view[start:end])
+                    if inspect.isawaitable(result):
+                        asyncio.ensure_future(result)
+                start = scan = end + len(LINE_TERMINATOR)
+        except Exception as exc:  # fail like the handler was called by run()
+            self._closed.set_exception(exc)
+            self._transport.abort()
+        if start == end_of_data: start = self._end = 0
+        self._start = start
 
 class ProtocolReplyEventQueue(object):
-    queue = defaultdict(set)
-    
-    @synchronized(expect_lock)
-    def expect(self, coroutine, replies):
+    """Generator coroutines waiting for numeric IRC replies.
+
+    A coroutine is sent each reply it expects as it arrives, and stops
+    waiting once it returns something other than None (or finishes).
+    If none of its replies arrives within its timeout, it is sent
+    TIMEOUT instead and dropped.
+
+    >>> replies = ProtocolReplyEventQueue()
+    >>> def waiter():
+    ...     while True:
+    ...         if (yield) == 1: yield 'done'
+    >>> coroutine = waiter(); next(coroutine)
+    >>> replies.expect(coroutine, (1, 2))
+    >>> replies.fulfil(2); replies.pending
+    1
+    >>> replies.fulfil(1); replies.pending, replies.fulfilled
+    (0, 1)
+    """
+    TIMEOUT = -1  # sent to coroutines instead of a reply that never came
+
+    def __init__(self, timeout=60, call_later=None):
+        self.timeout = timeout  # default, in seconds
+        self._call_later = call_later  # e.g. Scheduler.call_later, for deadlines
+        self._lock = Lock()
+        self._waiters = {}  # reply -> {coroutine: None}, in order of expect()
+        self._expected = {}  # coroutine -> (replies, deadline Timer)
+        self.fulfilled = self.expired = 0
+
+    @property
+    def pending(self):
+        return len(self._expected)
+
+    def expect(self, coroutine, replies, timeout=None):
         """Marks the generator object coroutine as expecting one of the int replies"""
         if isinstance(replies, int): replies = (replies,)
         if any(filter(lambda i: not isinstance(i, int), replies)):
             log.error('expect() expects single numeric or a tuple/set/list of replies')
             sys.exit(1)
-        now = datetime.now()
-        for reply in replies:
-            self.queue[reply].add((now, coroutine))
-            self.queue[coroutine].add(reply)
+        timeout = self.timeout if timeout is None else timeout
+        with self._lock:
+            self._drop(coroutine)  # a new expectation replaces the old one
+            for reply in replies:
+                self._waiters.setdefault(reply, {})[coroutine] = None
+            deadline = (self._call_later(timeout, self._expire, coroutine)
+                        if timeout and self._call_later is not None else None)
+            self._expected[coroutine] = (tuple(replies), deadline)
 
-    @synchronized(expect_lock)
     def fulfil(self, reply):
-        """Runs the coroutine(s) waiting for reply, and if done, pops it from the queue"""
-        now = datetime.now()
-        for then, coroutine in self.queue.get(reply, set()).copy():
-            assert then < now, 'event should always be fired after scheduling for it'
-            done = coroutine.send(reply)
-            # If coroutine returned something (other than yielding None), remove it from queue
-            if done is not None:
-                self.queue[reply].remove((then, coroutine))
-                if 0 == len(self.queue[reply]):
-                    del self.queue[reply]
-                del self.queue[coroutine], coroutine
-
-conn_tx_lock = Lock()
+        """Sends reply to the coroutines waiting for it"""
+        with self._lock: waiting = self._waiters.pop(reply, None)
+        if not waiting: return
+        done = []
+        for coroutine in waiting:
+            if coroutine not in self._expected:  # expired meanwhile
+                done.append(coroutine)
+            elif self._send(coroutine, reply) is not None:
+                self.fulfilled += 1
+                done.append(coroutine)
+        with self._lock:
+            for coroutine in done:
+                del waiting[coroutine]
+                self._drop(coroutine)
+            if waiting:  # keep waiting, ahead of any expect()ed meanwhile
+                waiting.update(self._waiters.get(reply, ()))
+                self._waiters[reply] = waiting
+
+    def _expire(self, coroutine):
+        with self._lock:
+            if coroutine not in self._expected: return
+            replies = self._expected[coroutine][0]
+            self._drop(coroutine)
+            self.expired += 1
+        log.warning('Timed out expecting replies {} for {}'.format(replies, coroutine))
+        self._send(coroutine, self.TIMEOUT)
+
+    def _drop(self, coroutine):  # with self._lock held
+        replies, deadline = self._expected.pop(coroutine, ((), None))
+        if deadline is not None: deadline.cancel()
+        for reply in replies:
+            waiters = self._waiters.get(reply)
+            if waiters is None: continue  # popped by fulfil()
+            waiters.pop(coroutine, None)
+            if not waiters: del self._waiters[reply]
+
+    @staticmethod
+    def _send(coroutine, reply):
+        try: return coroutine.send(reply)
+        except StopIteration: return True
+        except Exception:
+            log.exception('Error in coroutine {} expecting replies'.format(coroutine))
+            return True
+
+PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_MESSAGE = range(3)
+MAX_LINE_BYTES = 510  # excluding LINE_TERMINATOR, see RFC 2812 section 2.3
+MIN_TEXT_BYTES = 100  # of a message line, however many targets it has
+
+class SendQueue(object):
+    """Outbound line scheduler with IRC flood control.
+
+    Lines are released by a token bucket: up to burst lines at once,
+    then rate lines per second. Pending lines wait in priority classes:
+    PONG and registration first, then other commands, then PRIVMSGs and
+    NOTICEs, which are taken round-robin across their targets. put() is
+    safe to call from any thread.
+
+    A message with the same text as a pending one to another target is
+    merged into it, as long as the line stays within max_line_bytes and
+    the server's targmax for the command (see RPL_ISUPPORT TARGMAX).
+
+    >>> q = SendQueue()
+    >>> for line in ('PRIVMSG #a :1', 'PRIVMSG #a :2', 'PRIVMSG #b :3', 'PONG :x'):
+    ...     q.put(line)
+    >>> len(q), q.max_depth
+    (4, 4)
+    >>> [q.get() for _ in range(len(q))]
+    ['PONG :x', 'PRIVMSG #a :1', 'PRIVMSG #b :3', 'PRIVMSG #a :2']
+    >>> q.targmax['privmsg'] = 2
+    >>> for chan in ('#a', '#b', '#c'): q.put('PRIVMSG {} :hi'.format(chan))
+    >>> q.get(), q.get(), q.get()
+    ('PRIVMSG #a,#b :hi', 'PRIVMSG #c :hi', None)
+    """
+    priorities = {
+        'pong': PRIORITY_HIGH, 'pass': PRIORITY_HIGH, 'cap': PRIORITY_HIGH,
+        'nick': PRIORITY_HIGH, 'user': PRIORITY_HIGH,
+        'privmsg': PRIORITY_MESSAGE, 'notice': PRIORITY_MESSAGE,
+    }
+    # minus the longest prefix (':' nick!user@host ' ') other clients will see
+    max_line_bytes = MAX_LINE_BYTES - (1 + 30 + 1 + 10 + 1 + 63 + 1)
+
+    def __init__(self, burst=5, rate=.5):
+        self.burst, self.rate = burst, rate
+        self.targmax = {}  # command -> max targets per message, set by Bot
+        self.sent = self.max_depth = 0
+        self.loop = None
+        self._loop_thread = None
+        self._ready = None  # asyncio.Event, set when a line is put
+        self._lock = Lock()
+        self._queues = tuple(OrderedDict() for _ in range(PRIORITY_MESSAGE + 1))  # target -> deque
+        self._depth = 0
+        self._mergeable = {}  # (command, text) -> last pending message entry
+        self._owners = {}  # target -> [queue key holding its pending messages, count]
+        self._tokens, self._refilled = burst, time.monotonic()
+
+    def __len__(self):
+        return self._depth
+
+    def depths(self):
+        """Returns number of pending lines in each priority class"""
+        with self._lock:
+            return [sum(map(len, queue.values())) for queue in self._queues]
+
+    def put(self, line):
+        command, _, rest = line.partition(' ')
+        command = command.lower()
+        priority = self.priorities.get(command, PRIORITY_NORMAL)
+        with self._lock:
+            if priority == PRIORITY_MESSAGE:
+                key, line = self._put_message(command, rest)
+                if line is None: return  # merged into a pending message
+            else: key = ''
+            queue = self._queues[priority]
+            try: queue[key].append(line)
+            except KeyError: queue[key] = deque((line,))
+            self._depth += 1
+            self.max_depth = max(self.max_depth, self._depth)
+        if self.loop is None: return  # run() will pick it up
+        if get_ident() == self._loop_thread: self._ready.set()
+        else: self.loop.call_soon_threadsafe(self._ready.set)
+
+    def _put_message(self, command, rest):
+        """Returns (queue key, new message entry) or (None, None) if merged.
+        A target's pending messages are all kept under one key, in order."""
+        target, _, text = rest.partition(' :')
+        owner = self._owners.get(target)
+        entry = self._mergeable.get((command, text))
+        if (entry is not None and (owner is None or owner[0] == entry[0]) and
+                self._queues[PRIORITY_MESSAGE][entry[0]][-1] is entry and
+                len(entry[2]) < self.targmax.get(command, 1) and
+                entry[4] + len(target.encode('utf-8')) + 1 <= self.max_line_bytes):
+            entry[2].append(target)
+            entry[4] += len(target.encode('utf-8')) + 1
+            key, entry = entry[0], None
+        else:
+            key = target if owner is None else owner[0]
+            length = len(command) + len(rest.encode('utf-8')) + 1
+            entry = [key, command.upper(), [target], text, length]  # see get()
+            self._mergeable[(command, text)] = entry
+        if owner is None: owner = self._owners[target] = [key, 0]
+        owner[1] += 1
+        return key, entry
+
+    def get(self):
+        """Pops the next line due, regardless of flood control, or returns None"""
+        with self._lock:
+            for queue in self._queues:
+                if queue: break
+            else: return None
+            key, lines = next(iter(queue.items()))
+            line = lines.popleft()
+            if lines: queue.move_to_end(key)  # round-robin
+            else: del queue[key]
+            self._depth -= 1
+            if isinstance(line, list):  # message entry
+                _, command, targets, text, _ = line
+                if self._mergeable.get((command.lower(), text)) is line:
+                    del self._mergeable[command.lower(), text]
+                for target in targets:
+                    owner = self._owners[target]
+                    owner[1] -= 1
+                    if not owner[1]: del self._owners[target]
+                line = '{} {} :{}'.format(command, ','.join(targets), text)
+            return line
+
+    def _token_delay(self):
+        """Refills the bucket; returns seconds until a token is available"""
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+        return 0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    async def run(self, send):
+        """Passes queued lines to send() as flood control allows"""
+        self.loop = asyncio.get_event_loop()
+        self._loop_thread = get_ident()
+        self._ready = asyncio.Event()
+        while True:
+            if not self._depth:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            delay = self._token_delay()
+            if delay:  # lines put meanwhile may take precedence
+                await asyncio.sleep(delay)
+                continue
+            line = self.get()
+            self._tokens -= 1
+            self.sent += 1
+            send(line)
+
+    async def flush(self, timeout):
+        """Waits until the queue is empty, but at most timeout seconds"""
+        deadline = time.monotonic() + timeout
+        while self._depth and time.monotonic() < deadline:
+            await asyncio.sleep(.1)
+
+class RegexSet(object):
+    """Finds which of many regexes match a text, in one scan.
+
+    The regexes are combined into one alternation of lookaheads, so the
+    scan stops at each position where any of them matches. There, the
+    alternatives after the one that matched are tried too. Leading
+    inline flags, e.g. '(?i)', are scoped to their regex. Regexes with
+    named groups or backreferences, or that can't be combined otherwise,
+    are searched separately.
+
+    >>> regexes = RegexSet([r'https?://', 'http', r'(?P<word>\\w+)!'])
+    >>> sorted(regexes.search('see http://example.com'))
+    [0, 1]
+    >>> sorted(regexes.search('HTTP wow!'))
+    [2]
+    >>> sorted(RegexSet([r'(?i)(?s)foo.', 'bar']).search('FOO\\n bar'))
+    [0, 1]
+    """
+    _FLAGS = ((re.A, 'a'), (re.I, 'i'), (re.M, 'm'), (re.S, 's'), (re.X, 'x'))
+    _INLINE_FLAGS = re.compile(r'^(?:\(\?[aiLmsux]+\))+')
+
+    def __init__(self, regexes):
+        self.regexes = [re.compile(regex) for regex in regexes]
+        parts, self._after, self._separate = [], {}, []
+        for i, regex in enumerate(self.regexes):
+            if (not isinstance(regex.pattern, str) or regex.groupindex or
+                    re.search(r'\\[1-9]|\(\?P=', regex.pattern)):
+                self._separate.append(i)
+                continue
+            flags = ''.join(flag for bit, flag in self._FLAGS if regex.flags & bit)
+            pattern = self._INLINE_FLAGS.sub('', regex.pattern)  # in regex.flags already
+            pattern = '(?{}:{})'.format(flags, pattern) if flags else pattern
+            part = '(?=(?P<_{}>{}))'.format(i, pattern)
+            try: re.compile(part)
+            except re.error:
+                self._separate.append(i)
+                continue
+            parts.append(part)
+            for after in self._after.values(): after.append(i)
+            self._after[i] = []
+        self._combined = re.compile('|'.join(parts)) if parts else None
+
+    def search(self, text):
+        """Returns the set of indexes of the regexes that match text"""
+        found = {i for i in self._separate if self.regexes[i].search(text)}
+        if self._combined is None: return found
+        for match in self._combined.finditer(text):
+            i = int(match.lastgroup[1:])
+            found.add(i)
+            for j in self._after[i]:
+                if j not in found and self.regexes[j].match(text, match.start()):
+                    found.add(j)
+        return found
+
+class Filter(object):
+    """Conditions a message must meet for a handler to be called: sent
+    to one of channels, its text starting with prefix (a str or tuple of
+    str), containing one of contains (a str or tuple of str, ignoring
+    case), and/or its text matching regex"""
+    __slots__ = ('channels', 'prefix', 'contains', 'regex')
+
+    def __init__(self, channels=None, prefix=None, contains=None, regex=None):
+        if isinstance(channels, str): channels = channels.split(',')
+        self.channels = channels and frozenset(channel.lower() for channel in channels)
+        self.prefix = tuple(prefix) if isinstance(prefix, list) else prefix
+        if isinstance(contains, str): contains = (contains,)
+        self.contains = contains and tuple(part.lower() for part in contains)
+        self.regex = regex and re.compile(regex)
+
+    @classmethod
+    def of(cls, handler):
+        """Returns the Filter declared by handler's channels, prefix and
+        regex attributes, or None"""
+        handler = getattr(handler, '__wrapped__', handler)  # e.g. Bot._blocking()
+        filter = cls(*(getattr(handler, name, None) for name in cls.__slots__))
+        return filter if filter.channels or filter.prefix or filter.contains or filter.regex else None
+
+class FilteredHandlers(object):
+    """The handlers of one event, some of them behind a Filter. The
+    cheap conditions are checked first; all the regexes are then matched
+    in one scan of each message's text, if any handler still needs it."""
+    def __init__(self, hooks):
+        self._hooks = hooks  # (handler, Filter or None)
+        regexes = [filter.regex for _, filter in hooks if filter and filter.regex]
+        self._regexes = RegexSet(regexes) if regexes else None
+        self._index = {regex: i for i, regex in enumerate(regexes)}
+        self._contains = any(filter and filter.contains for _, filter in hooks)
+
+    def select(self, message):
+        """Returns the handlers to call for message, in order"""
+        if message is None:
+            return tuple(hook for hook, filter in self._hooks if filter is None)
+        text = message.text or ''
+        channel = message.param[0].lower() if message.param else ''
+        lowered = text.lower() if self._contains else text
+        found, selected = None, []
+        for hook, filter in self._hooks:
+            if filter is not None:
+                if filter.channels and channel not in filter.channels: continue
+                if filter.prefix and not text.startswith(filter.prefix): continue
+                if filter.contains:
+                    for part in filter.contains:
+                        if part in lowered: break
+                    else: continue
+                if filter.regex:
+                    if found is None: found = self._regexes.search(text)
+                    if self._index[filter.regex] not in found: continue
+            selected.append(hook)
+        return tuple(selected)
+
+class Command(object):
+    """A command word a plugin handles, see CommandRouter"""
+    __slots__ = ('name', 'handler', 'aliases', 'usage', 'help')
+
+    def __init__(self, name, handler, aliases=(), usage=''):
+        self.name, self.handler, self.usage = name, handler, usage
+        self.aliases = tuple(alias.lower() for alias in aliases)
+        self.help = (handler.__doc__ or '').strip().split('\n')[0]
+
+class _TrieNode(object):
+    __slots__ = ('children', 'command', 'commands')
+
+    def __init__(self):
+        self.children = {}  # next character -> _TrieNode
+        self.command = None  # the Command whose name or alias ends here
+        self.commands = set()  # Commands whose name or alias starts here
+
+class CommandRouter(object):
+    """Command words and aliases, looked up in a prefix trie. A word
+    can be abbreviated as long as it stays unambiguous.
+
+    >>> commands = CommandRouter()
+    >>> def cmd_karma(bot, message, args): 'Shows karma stats'
+    >>> commands.add('karma', cmd_karma, aliases=('upvotes', 'leaderboard'))
+    >>> commands.add('kick', print)
+    >>> [command.name for word in ('karma', 'kar', 'up') for command in commands.find(word)]
+    ['karma', 'karma', 'karma']
+    >>> [command.name for command in commands.find('k')], commands.find('x')
+    (['karma', 'kick'], [])
+    """
+    def __init__(self):
+        self._commands = OrderedDict()  # name -> Command
+        self._root = _TrieNode()
+
+    def __len__(self):
+        return len(self._commands)
+
+    def __iter__(self):
+        return iter(self._commands.values())
+
+    def add(self, name, handler, aliases=(), usage=''):
+        name = name.lower()
+        if name in self._commands: log.warning('Replacing command ' + name)
+        self._commands[name] = Command(name, handler, aliases, usage)
+        self._rebuild()
+
+    def remove(self, name):
+        if self._commands.pop(name.lower(), None): self._rebuild()
+
+    def _rebuild(self):
+        root = _TrieNode()
+        for command in self._commands.values():
+            for word in (command.name,) + command.aliases:
+                node = root
+                for char in word:
+                    node = node.children.setdefault(char, _TrieNode())
+                    node.commands.add(command)
+                node.command = command
+        self._root = root  # swapped whole, like Bot's dispatch table
+
+    def find(self, word):
+        """Returns the list of Commands word (lowercase) could stand
+        for: the one it names exactly, else all it abbreviates"""
+        node = self._root
+        for char in word:
+            node = node.children.get(char)
+            if node is None: return []
+        if node.command is not None: return [node.command]
+        return sorted(node.commands, key=lambda command: command.name)
 
 def is_event_handler(event, re=re.compile('^on_(every_[0-9]+[smhd]|[a-z]+|[0-9]+)$')):
     return re.match(event)
 
+def event_key(event):
+    """Returns the dispatch table key, a command name or numeric code,
+    of an on_* event handler name
+
+    >>> event_key('on_privmsg'), event_key('on_366')
+    ('privmsg', 366)
+    """
+    event = event[len('on_'):]
+    return int(event) if event.isdigit() else event
+
+def is_blocking(plugin, event):
+    """Whether plugin's __blocking__ (True, or an event handler name or
+    a tuple of them) marks its event handler to run off the event loop"""
+    if event in ('on_load', 'on_unload'): return False  # must finish in place
+    blocking = getattr(plugin, '__blocking__', ())
+    if isinstance(blocking, str): blocking = (blocking,)
+    return blocking is True or event in blocking
+
 class Bot(object):
-    _connection = Connection()
-    _replies = ProtocolReplyEventQueue()
     plugins = {}
     log = log  # pass logging to plugins
 
@@ -181,6 +899,25 @@ class Bot(object):
                         self.config('main/channels')):
             log.warning('Invalid channels specified in config: ' + self.config('main/channels'))
         log.info('Starting botko with config: ' + str(self.config))
+        irc.FALLBACK_ENCODING = self.config('main/fallback_encoding')
+
+        self._hooks = {}  # command name or numeric code -> ((handler, Filter or None), ...)
+        self._handlers = {}  # the same, compiled: tuple of handlers or FilteredHandlers
+        self._handlers_lock = Lock()
+        self.commands = CommandRouter()
+        self.commands.add('help', self._cmd_help, ('commands',), '[command]')
+        self.scheduler = Scheduler()
+        self._every = []  # (seconds, on_every_* handler)
+        self._replies = ProtocolReplyEventQueue(float(self.config('main/reply_timeout')),
+                                                self.scheduler.call_later)
+        self._workers = WorkerPool(int(self.config('main/workers')),
+                                   int(self.config('main/worker_backlog')),
+                                   self.scheduler.call_later)
+        self.profiler = None
+        if self.config('main/profile_interval'):
+            self.profiler = self.scheduler.profiler = self._workers.profiler = Profiler()
+            self.scheduler.call_every(float(self.config('main/profile_interval')),
+                                      self._dump_profile)
 
         # import plugins and attach their on_* event handlers
         def plugin_modules():
@@ -191,37 +928,42 @@ class Bot(object):
                 if not filename.startswith('_') and extension == '.py':
                     yield ('plugins.' + filename, filename)
         def load_plugin(module, plugin_name):
-            try: return self.plugins[module] # already loaded
+            try: return self.plugins[plugin_name] # already loaded
             except KeyError: pass  # else continue loading
             log.info('Loading plugin: ' + plugin_name)
             from importlib import import_module
             plugin = import_module(module)
             self.plugins[plugin_name] = plugin
+            # process dependencies first, so their on_load hooks run first
+            depends = getattr(plugin, '__depends__', ())
+            if isinstance(depends, str):
+                depends = (depends,)
+            elif not isinstance(depends, Sequence):
+                log.error('__depends__ must be a str or tuple of str')
+                sys.exit(1)
+            for dependency in depends:
+                load_plugin('plugins.' + dependency, dependency)
             for event in plugin.__dict__:
+                if event.startswith('cmd_') and callable(getattr(plugin, event)):
+                    handler = getattr(plugin, event)
+                    self.commands.add(event[len('cmd_'):], self._blocking(plugin_name, handler)
+                                      if is_blocking(plugin, event) else handler,
+                                      getattr(handler, 'aliases', ()), getattr(handler, 'usage', ''))
+                    continue
                 if not event.startswith('on_'): continue
                 handler = getattr(plugin, event)
                 if not callable(handler): continue
                 if not is_event_handler(event):
                     log.warning('Skipping unrecognized event handler: ' + str(handler))
                     continue
+                if is_blocking(plugin, event):
+                    handler = self._blocking(plugin_name, handler)
                 if event.startswith('on_every_'):
                     _scalar = {'m':60, 'h':60*60, 'd':60*60*24}.get(event[-1], 1)
                     seconds = int(event[len('on_every_'):-1]) * _scalar
-                    handler = PeriodicExecutor(plugin_name + '.' + event,
-                                               seconds, handler, (self, None))
-                    event = 'on_every'
+                    self._every.append((seconds, handler))  # scheduled once joined
+                    continue
                 self.add_handler(event, handler)
-            # process dependencies
-            try: depends = plugin.__depends__
-            except AttributeError: return  # no __depends__ specified
-            if isinstance(depends, str):
-                load_plugin('plugin.' + depends, depends)
-            elif isinstance(depends, Sequence):
-                for dependency in depends:
-                    load_plugin('plugin.' + depends, depends)
-            else:
-                log.error('__depends__ must be a str or tuple of str')
-                sys.exit(1)
         for module, plugin_name in plugin_modules():
             if self.config(plugin_name + '/disabled'):
                 log.info('Skipping disabled plugin: ' + plugin_name)
@@ -231,39 +973,129 @@ class Bot(object):
         # execute any on_load hooks
         log.info('Triggering on_load event hooks ...')
         self._trigger_event('load')
+        with self._handlers_lock:  # pick up filters that on_load set
+            self._compile_handlers(self._hooks)
 
-        # set up socket connection
-        self._connection.set_terminator(LINE_TERMINATOR)
+        # set up socket connection (connected in start())
+        self._sendq = SendQueue(int(self.config('main/flood_burst')),
+                                float(self.config('main/flood_rate')))
+        self._sender = None  # SendQueue.run() task
+        self.isupport = {}  # RPL_ISUPPORT parameters the server advertised
+        self.nick = ''  # set once the server accepts one
+        self._connection = Connection()
         self._connection.set_line_handler(self._process_line)
         self._connection.handle_connect = self._handle_connect()
-        self._connection.create_socket(asynchat.socket.AF_INET,
-                                       asynchat.socket.SOCK_STREAM)
-        log.info('Connecting to {server}:{port}'.format(**self.config['main']))
-        self._connection.connect((self.config('main/server'),
-                                  int(self.config('main/port'))))
-        log.info('Starting event loop')
+
+        self.metrics = Metrics()
+        self.metrics.gauge('sendq_depth', 'Lines waiting in the send queue', self._sendq.__len__)
+        self.metrics.gauge('sendq_max_depth', 'Most lines ever waiting in the send queue',
+                           lambda: self._sendq.max_depth)
+        self.metrics.gauge('expectations_pending', 'Coroutines waiting for a reply',
+                           lambda: self._replies.pending)
+        self.metrics.gauge('expectations_expired_total', 'Coroutines whose reply never came',
+                           lambda: self._replies.expired, 'counter')
+        self.metrics.gauge('worker_pending', 'Blocking handler calls waiting or running',
+                           lambda: self._workers.pending)
+        self.metrics.gauge('worker_dropped_total', 'Blocking handler calls dropped',
+                           lambda: self._workers.dropped, 'counter')
+        self.metrics.gauge('worker_timeouts_total', 'Blocking handler calls abandoned',
+                           lambda: self._workers.timeouts, 'counter')
+        self._metrics_server = None
+        if self.config('main/metrics_interval'):
+            self.scheduler.call_every(float(self.config('main/metrics_interval')),
+                                      self._write_metrics)
 
     def run(self):
-        asynchat.asyncore.loop()
+        log.info('Starting event loop')
+        asyncio.run(self.start())
+
+    async def start(self):
+        """Connects to the server and processes lines until disconnected.
+        To run many bots on one event loop, await their start()s together."""
+        if self.config('main/metrics_port'):
+            self._metrics_server = await self.metrics.serve(int(self.config('main/metrics_port')))
+        log.info('Connecting to {server}:{port}'.format(**self.config['main']))
+        try:
+            await self._connection.run(self.config('main/server'),
+                                       int(self.config('main/port')))
+        except asyncio.CancelledError:  # e.g. KeyboardInterrupt in run()
+            await self._handle_close()
+            raise
 
     def _trigger_event(self, event, message=None):
-        assert not event.startswith('on_')
-        event = 'on_' + str(event)
-        for hook in getattr(self, event, ()):
-            log.level >= logging.DEBUG and log.debug(
-                'Running {event} hook {hook}'.format(event=event, hook=hook))
-            hook(self, message) # TODO message
-
-    @synchronized(conn_tx_lock)
+        """Runs the handlers of event, a command name or numeric code"""
+        hooks = self._handlers.get(event)
+        if not hooks: return
+        if isinstance(hooks, FilteredHandlers): hooks = hooks.select(message)
+        debug, profiler = log.isEnabledFor(logging.DEBUG), self.profiler
+        for hook in hooks:
+            if debug: log.debug('Running on_{event} hook {hook}'.format(event=event, hook=hook))
+            result = (hook(self, message) if profiler is None else
+                      profiler.call(handler_key(hook, 'on_{}'.format(event)), hook, self, message))
+            if asyncio.iscoroutine(result):  # async def handlers run as tasks
+                asyncio.ensure_future(result)
+
     def _write(self, line):
-        log.level >= logging.DEBUG and log.debug('TX bytes: ' + line)
-        self._connection.push(bytes(line) + LINE_TERMINATOR)
+        """Queues line for sending, see SendQueue"""
+        self._sendq.put(line)
+
+    def _send_line(self, line):
+        if log.isEnabledFor(logging.DEBUG): log.debug('TX bytes: ' + line)
+        data = bytes(line) + LINE_TERMINATOR
+        self.metrics.tx_lines_total += 1
+        self.metrics.tx_bytes_total += len(data)
+        self._connection.push(data)
+
+    def reply(self, message, text):
+        """Replies to message, in its channel or privately"""
+        channel = message.param[0]
+        if channel.startswith(irc.CHANNEL_PREFIXES):
+            self.privmsg(channel, '{}: {}'.format(message.nick, text))
+        else:
+            self.privmsg(message.nick, text)
 
     def privmsg(self, target, text):
-        self._write('PRIVMSG {} :{}'.format(target, text))
+        self._message('PRIVMSG', target, text)
 
     def notice(self, target, text):
-        self._write('NOTICE {} :{}'.format(target, text))
+        self._message('NOTICE', target, text)
+
+    def _message(self, command, targets, text):
+        """Queues text to comma-separated targets, split into as many
+        lines as needed. SendQueue merges lines to several targets again,
+        as far as the server's TARGMAX allows."""
+        targets = targets.split(',')
+        per_line = min(len(targets), self._sendq.targmax.get(command.lower(), 1))
+        line_bytes = self._sendq.max_line_bytes
+        overhead = len(command) + 2  # ' :', then the longest targets that fit one line
+        for length in sorted((len(t.encode('utf-8')) + 1 for t in targets), reverse=True)[:per_line]:
+            if overhead + length > line_bytes - MIN_TEXT_BYTES: break
+            overhead += length
+        for chunk in irc.split_text(text, max(line_bytes - overhead, MIN_TEXT_BYTES)):
+            for target in targets:
+                self._write('{} {} :{}'.format(command, target, chunk))
+
+    def _handle_isupport(self, message):
+        for token in message.param[1:]:
+            key, _, value = token.partition('=')
+            self.isupport[key] = value
+            if key == 'TARGMAX':
+                for pair in value.split(','):
+                    command, _, limit = pair.partition(':')
+                    self._sendq.targmax[command.lower()] = int(limit) if limit else sys.maxsize
+            elif key == 'MAXTARGETS':
+                for command in ('privmsg', 'notice'):
+                    self._sendq.targmax.setdefault(command, int(value))
+
+    def call_later(self, delay, func, *args):
+        """Calls func(*args) on the event loop after delay seconds.
+        Returns a Timer, which can be cancel()-ed."""
+        return self.scheduler.call_later(delay, func, *args)
+
+    def call_every(self, interval, func, *args, jitter=0):
+        """Calls func(*args) on the event loop every interval seconds,
+        until it returns a true value. See Scheduler.call_every()."""
+        return self.scheduler.call_every(interval, func, *args, jitter=jitter)
 
     def every_so_often(self):
         # TODO check if nick available
@@ -271,38 +1103,83 @@ class Bot(object):
         # check if queues are empty
         pass
  
-    def expect(self, coroutine, replies, autostart=False):
+    def expect(self, coroutine, replies, autostart=False, timeout=None):
+        """Sends coroutine the replies as they arrive, or
+        ProtocolReplyEventQueue.TIMEOUT after timeout seconds
+        (main/reply_timeout by default)"""
         if autostart: next(coroutine)
-        log.level >= logging.DEBUG and log.debug(
-            'Expecting replies {} for coroutine {}'.format(replies, coroutine))
-        self._replies.expect(coroutine, replies)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Expecting replies {} for coroutine {}'.format(replies, coroutine))
+        self._replies.expect(coroutine, replies, timeout)
     
-    def add_handler(self, event, handler):
+    def _blocking(self, plugin_name, handler):
+        """Wraps handler to run on the worker pool, in order with the rest
+        of plugin_name's blocking handlers"""
+        if inspect.iscoroutinefunction(handler):
+            log.warning('Not running async handler {} on a thread'.format(handler))
+            return handler
+        timeout = float(self.config(plugin_name + '/handler_timeout') or
+                        self.config('main/handler_timeout'))
+        def blocking_handler(*args):
+            self._workers.submit(plugin_name, timeout, handler, *args)
+        return update_wrapper(blocking_handler, handler)
+
+    def add_handler(self, event, handler, channels=None, prefix=None, contains=None, regex=None):
+        """Calls handler(bot, message) on event. If channels, prefix,
+        contains or regex are given, or set as handler's attributes,
+        only for the messages that match them, see Filter."""
         if not is_event_handler(event) or not callable(handler):
             log.error('Invalid event or event handler: {}: {}'.format(event, handler))
             return
-        try: getattr(self, event).append(handler)
-        except AttributeError:
-            setattr(self, event, [handler])
-        finally: log.debug('Attached event handler ' + str(handler))
-    
+        filter = (Filter(channels, prefix, contains, regex)
+                  if channels or prefix or contains or regex else None)
+        key = event_key(event)
+        with self._handlers_lock:
+            hooks = dict(self._hooks)
+            hooks[key] = hooks.get(key, ()) + ((handler, filter),)
+            self._compile_handlers(hooks)
+        log.debug('Attached event handler ' + str(handler))
+
     def remove_handler(self, event, handler):
-        try: getattr(self, event).remove(handler)
-        except AttributeError, ValueError:
-            log.warning('Event handler not active for event {}: {}'.format(event, handler))
-            return False
-        else: log.debug('Removed event handler ' + str(handler))
+        key = event_key(event)
+        with self._handlers_lock:
+            entries = self._hooks.get(key, ())
+            for i, (hook, _) in enumerate(entries):
+                if getattr(hook, '__wrapped__', hook) is handler or hook is handler:
+                    break  # also finds _blocking()-wrapped handlers
+            else:
+                log.warning('Event handler not active for event {}: {}'.format(event, handler))
+                return False
+            hooks = dict(self._hooks)
+            hooks[key] = entries[:i] + entries[i + 1:]
+            if not hooks[key]: del hooks[key]
+            self._compile_handlers(hooks)
+        log.debug('Removed event handler ' + str(handler))
+
+    def _compile_handlers(self, hooks):  # with self._handlers_lock held
+        # The dispatch table is never modified in place, but replaced whole,
+        # so _trigger_event() needs no lock and never sees it half-updated.
+        handlers = {}
+        for key, entries in hooks.items():
+            entries = tuple((hook, filter or Filter.of(hook)) for hook, filter in entries)
+            handlers[key] = (FilteredHandlers(entries) if any(filter for _, filter in entries)
+                             else tuple(hook for hook, _ in entries))
+        self._hooks, self._handlers = hooks, handlers
 
     def _handle_connect(self):
         """closures self so it is available in handle_connect"""
         # TODO move this to a separate plugin?
         # FIXME: this all is shit, fix this!!!
         def handle_connect():
-            """called by asyncore on connection established."""
+            """called by Connection on connection established."""
+            if self.metrics.connections_total: self.metrics.reconnects_total += 1
+            self.metrics.connections_total += 1
+            self._sender = asyncio.ensure_future(self._sendq.run(self._send_line))
+            self.scheduler.start()
             def set_nick():
                 """cycles possible nicknames until one is accepted"""
                 nicks = self.config('main/nick').strip(',').split(',')
-                for suffix in ' 12345':
+                for suffix in ('', '1', '2', '3', '4', '5'):
                     for nick in nicks:
                         nick = nick.strip() + suffix
                         self._write('NICK {}'.format(nick))
@@ -323,9 +1200,9 @@ class Bot(object):
                 self._write('JOIN ' + channels)
                 reply = (yield)
                 if reply == irc.RPL_ENDOFNAMES:
-                    try: log.info('Starting {} "on_every" threads'.format(
-                                  len([thread.start() for thread in self.on_every])))
-                    except AttributeError: pass
+                    log.info('Scheduling {} "on_every" handlers'.format(len(self._every)))
+                    for seconds, handler in self._every:
+                        self.call_every(seconds, handler, self, None)
                     self.channels = channels.split(' ')[0].split(',')  # HACK
                     yield True; return
                 else: log.error('Could not join channels. IRC reply: ' + str(reply))
@@ -333,34 +1210,119 @@ class Bot(object):
             self.expect(set_nick(), irc.REPLIES_NICK, True)
             self.expect(register_user(), irc.REPLIES_USER, True)
             self.expect(join_channels(), irc.REPLIES_JOIN, True)
-        self._trigger_event('connect')
+            self._trigger_event('connect')
         return handle_connect
 
-    def _handle_close(self):
+    async def _handle_close(self):
         # TODO restart if not quit on purpose, or is that in connection.handle_close() ?
         log.info('Unloading plugins ...')
         self._trigger_event('unload')
-        from time import sleep
-        sleep(1)  # HACK
+        await self._sendq.flush(timeout=5)
+        if self._sender is not None: self._sender.cancel()
+        self._workers.shutdown()
+        if self.profiler is not None: self._dump_profile()
+        if self.config('main/metrics_interval'): self._write_metrics()
+        if self._metrics_server is not None: self._metrics_server.close()
         log.info('Closing connection')
         self._connection.close()
+        await self._connection.wait_closed()
 
     def _process_line(self, line):
-        log.level >= logging.DEBUG and log.debug('RX bytes: ' + line.decode('utf-8'))
-        message = irc.parse_line(line.decode('utf-8'))
+        metrics, started = self.metrics, time.perf_counter()
+        message = irc.parse_line(line)  # decodes lazily, see irc.Message
+        parsed = time.perf_counter()
+        metrics.rx_lines_total += 1
+        metrics.rx_bytes_total += len(line) + len(LINE_TERMINATOR)
+        metrics.parse_seconds_total += parsed - started
+        if message is None: return
+        try: self._dispatch(message)
+        finally: metrics.dispatch_seconds_total += time.perf_counter() - parsed
+
+    def _dispatch(self, message):
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('RX bytes: ' + message.line)
         code, command = message.code, message.command
         if code:
             self._replies.fulfil(code)
             if code == irc.RPL_WELCOME:
                 self._trigger_event('welcome', message)
-        if command == 'privmsg':
+            elif code == irc.RPL_ISUPPORT:
+                self._handle_isupport(message)
+        elif command == 'join' and message.nick == getattr(self, 'nick', None):
+            # now we know the exact prefix others see on our messages
+            self._sendq.max_line_bytes = MAX_LINE_BYTES - len(
+                ':{}!{}@{} '.format(message.nick, message.user, message.host).encode('utf-8'))
+        handlers = self._handlers
+        if command == 'privmsg' and ('ctcp' in handlers or 'chanmsg' in handlers):
             if message.text.startswith('\x01') and message.text.endswith('\x01'):
                 self._trigger_event('ctcp', message)
-            elif message.param[0].startswith(('#', '&', '+', '!')):
+            elif message.param[0].startswith(irc.CHANNEL_PREFIXES):
                 self._trigger_event('chanmsg', message)
-            else:
-                self._trigger_event('privmsg', message)
-        self._trigger_event(str(command), message)
+            # on_privmsg runs for every PRIVMSG, below
+        self._trigger_event(command, message)
+        if command == 'privmsg' and self.nick:
+            self._route_command(message)
+
+    def _route_command(self, message):
+        """Runs the command in message, if it is addressed to the bot
+        ('botko: command args...') or sent to it privately"""
+        text, nick = message.text, self.nick
+        if text[:len(nick)].lower() == nick.lower() and text[len(nick):len(nick) + 1] in (':', ',', ' '):
+            text = text[len(nick) + 1:]
+        elif message.param[0].startswith(irc.CHANNEL_PREFIXES) or text.startswith('\x01'):
+            return  # not for us
+        args = text.split()
+        if not args: return
+        word = args.pop(0).lower()
+        commands = self.commands.find(word)
+        if len(commands) != 1:
+            # in channels, answer only what looks like a mistyped command, not chat
+            close = not commands and get_close_matches(
+                word, [name for command in self.commands for name in (command.name,) + command.aliases],
+                cutoff=.75)
+            if commands:
+                self.reply(message, "'{}' could be: {}".format(word, ', '.join(
+                    command.name for command in commands)))
+            elif close:
+                self.reply(message, "I don't know '{}'. Did you mean: {}?".format(word, ', '.join(close)))
+            elif not message.param[0].startswith(irc.CHANNEL_PREFIXES):
+                self.reply(message, "I don't know '{}'. Try: {} help".format(word, nick))
+            return
+        command, profiler = commands[0], self.profiler
+        try:
+            result = (command.handler(self, message, args) if profiler is None else
+                      profiler.call(handler_key(command.handler, 'cmd_' + command.name),
+                                    command.handler, self, message, args))
+        except Exception:
+            log.exception('Error in command {!r}'.format(text))
+            return
+        if asyncio.iscoroutine(result): asyncio.ensure_future(result)
+
+    def _cmd_help(self, bot, message, args):
+        """Lists commands, or explains one"""
+        commands = self.commands.find(args[0].lower()) if args else ()
+        if len(commands) != 1:
+            self.reply(message, 'Commands: {}. Say "{} help <command>" for more.'.format(
+                ', '.join(command.name + (' ({})'.format(', '.join(command.aliases))
+                                          if command.aliases else '')
+                          for command in self.commands), self.nick))
+            return
+        command = commands[0]
+        self.reply(message, '{} {}{} - {}'.format(
+            self.nick, command.name, ' ' + command.usage if command.usage else '',
+            command.help or 'no help available'))
+
+    def _write_metrics(self):
+        """Writes metrics to data_dir/botko.prom"""
+        filename = self._ensure_endswith_slash(self.config('main/data_dir')) + 'botko.prom'
+        try: self.metrics.write(filename)
+        except OSError as exc: log.error('Could not write {}: {}'.format(filename, exc))
+
+    def _dump_profile(self):
+        """Writes handler profiling stats to data_dir/profile.json"""
+        filename = self._ensure_endswith_slash(self.config('main/data_dir')) + 'profile.json'
+        try: self.profiler.dump(filename)
+        except OSError as exc: log.error('Could not write {}: {}'.format(filename, exc))
 
     def _ensure_endswith_slash(self, dir):
         if not dir: return ''
@@ -395,12 +1357,12 @@ def main():
     except ImportError:
         from ConfigParser import ConfigParser
     parser = ConfigParser()
-    with open(args.config) as f: parser.readfp(f)
+    with open(args.config) as f: parser.read_file(f)
     try:
         bot = Bot(parser._sections)  # ConfigParser provides dict of dicts in _sections
-        bot.run()
+        bot.run()  # unloads plugins and closes the connection on KeyboardInterrupt
     except KeyboardInterrupt:
-        bot._handle_close()
+        pass
     except Exception as e: excepthook()
 
 
@@ -1,7 +1,18 @@
 
+import io
 import re
+import time
+import mmap
 import logging
-from collections import namedtuple
+
+try: from sys import intern  # python 3
+except ImportError:  # python 2's intern() doesn't take unicode
+    def intern(string, _interned={}):
+        return _interned.setdefault(string, string)
+
+_RAW = (bytes,) if bytes is not str else ()  # python 2 str is already text
+
+CHANNEL_PREFIXES = ('#', '&', '+', '!')
 
 # patterns from: https://tools.ietf.org/html/rfc2812#section-2.3.1
 _PATTERN_JOIN_PARAMS = '^[#&+!][^ ,\x00\x07\x0D]+(,[#&+!][^ ,\x00\x07\x0D]+)?( *([^ ,\x00\x09-\x0D]+(,[^ ,\x00\x09-\x0D]+)?)?)?$'
@@ -11,10 +22,8 @@ _PATTERN_PREFIX = '(:((?P<server>[\w\.-]+)|(?P<nick>' + _PATTERN_NICKNAME + ')((
 _PATTERN_PARAMS = '((?P<param>(?: +[^:][^ \x00\x0D\x0A]*)*)(?P<text> :?[^\x00\x0D\x0A]*)?)?'
 PATTERN_IRC_MESSAGE = _PATTERN_PREFIX + '((?P<code>[0-9]+)|(?P<command>[A-Za-z]+))' + _PATTERN_PARAMS
 
-Message = namedtuple('Message', 'server nick user host code command param token text line')  # see parse_line()
-
 class _MetaNull(type): pass
-class Null(type):
+class Null(_MetaNull('_Null', (type,), {})):  # python 2 and 3 metaclass
     """Null object design pattern.
     
     This class traps and ignores everything. Instances of it always and
@@ -141,11 +150,134 @@ class nulltuple(tuple):
     returns Null object if index is out of range.
     """
     def __getitem__(self, key):
+        if isinstance(key, slice):
+            return nulltuple(tuple.__getitem__(self, key))
         return tuple.__getitem__(self, key) if key < len(self) else Null
 
-def parse_line(line):
-    """ Parses IRC message line into Message namedtuple.
-    Message.text is already split into a nulltuple of words.
+class Message(object):
+    """IRC message, as returned by parse_line().
+
+    Behaves like a namedtuple with fields
+    (server, nick, user, host, code, command, param, token, text, line),
+    but param and token are only split into nulltuples when first
+    accessed. If text and line are given as raw bytes, they are only
+    decoded (see decode()) when first accessed.
+
+    >>> m = Message('', 'nick', 'user', 'host', 0, 'privmsg', '#chan', text='hi there')
+    >>> m.param, m.token, m[1], len(m)
+    (('#chan',), ('hi', 'there'), 'nick', 10)
+    >>> server, nick, user, host, code, command, param, token, text, line = m
+    >>> m == tuple(m) and m._replace(text='bye').token
+    ('bye',)
+    """
+    __slots__ = ('server', 'nick', 'user', 'host', 'code', 'command',
+                 '_param', '_token', '_text', '_line')
+    _fields = ('server', 'nick', 'user', 'host', 'code', 'command',
+               'param', 'token', 'text', 'line')
+
+    def __init__(self, server='', nick='', user='', host='', code=0, command='',
+                 param='', token=None, text='', line=''):
+        self.server = server
+        self.nick = nick
+        self.user = user
+        self.host = host
+        self.code = code
+        self.command = command
+        self._param = param  # str or already split nulltuple
+        self._token = token  # None until split
+        self._text = text  # str or raw bytes
+        self._line = line  # str or raw bytes
+
+    @property
+    def param(self):
+        param = self._param
+        if not isinstance(param, tuple):
+            param = param.split()
+            if param: param[0] = intern(param[0])  # channel or our nick
+            param = self._param = nulltuple(param)
+        return param
+
+    @property
+    def token(self):
+        token = self._token
+        if token is None:
+            token = self._token = nulltuple(self.text.split())
+        return token
+
+    @property
+    def text(self):
+        text = self._text
+        if isinstance(text, _RAW):
+            text = self._text = decode(text)
+        return text
+
+    @property
+    def line(self):
+        line = self._line
+        if isinstance(line, _RAW):
+            line = self._line = decode(line)
+        return line
+
+    def __iter__(self):
+        return (getattr(self, field) for field in self._fields)
+    def __len__(self):
+        return len(self._fields)
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self)[index]
+        return getattr(self, self._fields[index])
+    def __eq__(self, other):
+        if not isinstance(other, (tuple, Message)): return NotImplemented
+        return tuple(self) == tuple(other)
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+    def __hash__(self):
+        return hash(tuple(self))
+    def __reduce__(self):
+        return (Message, tuple(self))
+    def __repr__(self):
+        return 'Message({})'.format(', '.join(
+            '{}={!r}'.format(field, value) for field, value in zip(self._fields, self)))
+
+    def _asdict(self):
+        return dict(zip(self._fields, self))
+    def _replace(self, **kwargs):
+        fields = self._asdict()
+        if 'text' in kwargs and 'token' not in kwargs:
+            fields['token'] = None  # re-split new text
+        fields.update(kwargs)
+        return Message(**fields)
+
+FALLBACK_ENCODING = 'latin-1'
+
+def decode(data):
+    """Decodes raw bytes as UTF-8, or as FALLBACK_ENCODING if that fails.
+    Each line is tried on its own, as clients in one channel can use
+    different encodings. ASCII, most lines, is decoded without trying.
+
+    >>> decode(b'\\xe8a\\xef') == u'\\xe8a\\xef'
+    True
+    >>> decode(b'\\xc5\\xa1ah') == u'\\u0161ah'
+    True
+    """
+    if data.isascii(): return data.decode('ascii')
+    try: return data.decode('utf-8')
+    except UnicodeDecodeError: return data.decode(FALLBACK_ENCODING)
+
+def parse_line(line, strict=False):
+    """ Parses IRC message line into a Message.
+    Message.text is also available split into a nulltuple of words,
+    Message.token.
+
+    By default, a fast split-based parser is used. It gives the same
+    result for any well-formed line, but only checks the line loosely.
+    With strict=True, the line is validated against PATTERN_IRC_MESSAGE.
+
+    The line can also be raw bytes (or bytearray or memoryview), as
+    received from the server. Then only the message head (prefix,
+    command and params) is decoded right away; text and line are
+    decoded when a handler first reads them.
     
     >>> parse_line(':HairyFodder!~Xatic@isp.example.com PRIVMSG #python :some1 speak python here?')
     Message(server='', nick='HairyFodder', user='~Xatic', host='isp.example.com', code=0, command='privmsg', param=('#python',), token=('some1', 'speak', 'python', 'here?'), text='some1 speak python here?', line=':HairyFodder!~Xatic@isp.example.com PRIVMSG #python :some1 speak python here?')
@@ -153,24 +285,195 @@ def parse_line(line):
     Message(server='pool.freenode.net', nick='', user='', host='', code=5, command=5, param=('NiCk', 'EXTBAN=$,arxz', 'WHOX', 'CLIENTVER=3.0'), token=('are', 'supported', 'by', 'this', 'server'), text='are supported by this server', line=':pool.freenode.net 005 NiCk EXTBAN=$,arxz WHOX CLIENTVER=3.0 :are supported by this server')
     >>> parse_line('JOIN #foobar')
     Message(server='', nick='', user='', host='', code=0, command='join', param=('#foobar',), token=(), text='', line='JOIN #foobar')
+    >>> line = ':nick!user@host.com PRIVMSG #chan :hello :)'
+    >>> parse_line(line) == parse_line(line, strict=True)
+    True
+    >>> parse_line(b':nick!user@host.com PRIVMSG #chan :\\xc5\\xa1ah').text == u'\\u0161ah'
+    True
     """
-    m = parse_line.regex.match(line)
+    if isinstance(line, memoryview): line = line.tobytes()
+    elif isinstance(line, bytearray): line = bytes(line)
+    raw = isinstance(line, _RAW)
+    if strict:
+        return _parse_line_strict(decode(line) if raw else line)
+    if raw:
+        head, _, text = line.partition(b' :')
+        head = decode(head)
+    else:
+        head, _, text = line.partition(' :')
+    server = nick = user = host = ''
+    if head.startswith(':'):
+        prefix, _, head = head[1:].partition(' ')
+        if '@' in prefix or '!' in prefix:
+            nick, _, host = prefix.partition('@')
+            nick, _, user = nick.partition('!')
+        elif '.' in prefix or prefix.replace('-', '').replace('_', '').isalnum():
+            server = prefix
+        else:
+            nick = prefix
+    command, _, param = head.partition(' ')
+    if command.isdigit():
+        code = command = int(command)
+    elif command.isalpha():
+        code, command = 0, intern(command.lower())
+    else:  # malformed; let the strict parser report it
+        return _parse_line_strict(decode(line) if raw else line)
+    return Message(intern(server), intern(nick), intern(user), intern(host),
+                   code, command, param, None, text, line)
+
+def _parse_line_strict(line):
+    """Regex-based parse_line(), which validates the line"""
+    m = _parse_line_strict.regex.match(line)
     if not m:
         return logging.error('provided line does not match IRC specification: ' + line)
     (server, nick, user, host,
      code, command, param, text) = map(lambda i: i or '',
                                         m.group('server', 'nick', 'user', 'host',
                                                 'code', 'command', 'param', 'text'))
-    command = command.lower()
-    param = nulltuple(param[1:].split())  # strip leading SP
+    command = intern(command.lower())
+    param = param[1:]  # strip leading SP
     text = text[2:]  # strip leading SP:
-    token = nulltuple(text.split())
     try: code, command = int(code), int(code)
     except ValueError: code = 0
-    return Message(server=server, nick=nick, user=user, host=host,
-                   code=code, command=command, param=param,
-                   token=token, text=text, line=line)
-parse_line.regex = re.compile('^{}$'.format(PATTERN_IRC_MESSAGE))
+    return Message(intern(server), intern(nick), intern(user), intern(host),
+                   code, command, param, None, text, line)
+_parse_line_strict.regex = re.compile('^{}$'.format(PATTERN_IRC_MESSAGE))
+
+def split_text(text, limit):
+    """Splits text into chunks of at most limit bytes, UTF-8 encoded.
+    Chunks are split at spaces where possible, never within a character.
+
+    >>> split_text('one two three', 8)
+    ['one two', 'three']
+    >>> split_text(u'\\u0161\\u0161\\u0161', 5) == [u'\\u0161\\u0161', u'\\u0161']
+    True
+
+    A character longer than limit makes a chunk of its own:
+
+    >>> split_text(u'\\u20ac\\u20ac', 2) == [u'\\u20ac', u'\\u20ac']
+    True
+    >>> split_text('abc def', 0)
+    Traceback (most recent call last):
+    ...
+    ValueError: limit must be at least 1 byte
+    """
+    if limit < 1: raise ValueError('limit must be at least 1 byte')
+    data = text.encode('utf-8')
+    if len(data) <= limit: return [text]
+    chunks = []
+    while len(data) > limit:
+        cut = data.rfind(b' ', 0, limit + 1)
+        if cut > 0:
+            chunk, data = data[:cut], data[cut + 1:]
+        else:
+            cut = limit
+            while cut and bytearray(data[cut:cut + 1])[0] & 0xC0 == 0x80:  # UTF-8 continuation byte
+                cut -= 1
+            if not cut:  # one character is longer than limit; keep it whole
+                cut = 1
+                while cut < len(data) and bytearray(data[cut:cut + 1])[0] & 0xC0 == 0x80:
+                    cut += 1
+            chunk, data = data[:cut], data[cut:]
+        chunks.append(chunk.decode('utf-8'))
+    if data: chunks.append(data.decode('utf-8'))
+    return chunks
+
+def parse_lines(source, terminator=b'\r\n', marker=None):
+    """Generates a Message for each line in source, which is a buffer
+    (bytes, bytearray, mmap, ...) or a binary file of raw IRC traffic.
+
+    Lines are split without copying the buffer. Plain files read from
+    the start are mmap-ed; other files (e.g. from gzip.open(), or read
+    from elsewhere) are read in chunks from where they are. If marker is given, only
+    lines containing it are parsed, starting right after it. E.g. to
+    parse the received lines in a botko debug log (botko.py -vv), use
+    terminator=b'\n', marker=b'RX bytes: '.
+
+    When done, parsing speed is logged at INFO level.
+
+    >>> [m.command for m in parse_lines(b'PING :x\\r\\n:a!b@c JOIN #d\\r\\n\\r\\nQUIT')]
+    ['ping', 'join', 'quit']
+    >>> log = b'... RX bytes: PING :x\\n... TX bytes: PONG :x\\n'
+    >>> [m.command for m in parse_lines(log, b'\\n', b'RX bytes: ')]
+    ['ping']
+    >>> import gzip, tempfile
+    >>> with tempfile.NamedTemporaryFile() as f:
+    ...     with gzip.open(f.name, 'wb') as traffic: _ = traffic.write(b'PING :x\\r\\nQUIT\\r\\n')
+    ...     [m.command for m in parse_lines(gzip.open(f.name))]
+    ['ping', 'quit']
+    >>> with tempfile.TemporaryFile() as f:
+    ...     _ = f.write(b'PING :x\\r\\nJOIN #d\\r\\nQUIT\\r\\n'); _ = f.seek(0)
+    ...     full = [m.command for m in parse_lines(f)]
+    ...     _ = f.seek(0); _ = f.readline()
+    ...     full, [m.command for m in parse_lines(f)]
+    (['ping', 'join', 'quit'], ['join', 'quit'])
+    """
+    if hasattr(source, 'read'):
+        # a compressed file's fileno() is that of the compressed data
+        if isinstance(source, (io.FileIO, io.BufferedReader)) and source.seekable() and not source.tell():
+            return _parse_mapped(source, terminator, marker)
+        return _parse_file(source, terminator, marker)
+    return _parse_buffer(source, terminator, marker)
+
+def _parse_mapped(file, terminator, marker):
+    try: buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError):  # empty file, ...
+        yield from _parse_file(file, terminator, marker)
+        return
+    try:
+        yield from _parse_buffer(buffer, terminator, marker)
+        file.seek(0, io.SEEK_END)  # as if read
+    finally:
+        buffer.close()
+
+def _parse_view(buffer, terminator, marker, final, stats):
+    """Generates Messages of complete lines in buffer (and, if final, of
+    the last line without terminator). Updates stats with the number of
+    lines parsed and the position after the last complete line."""
+    view = memoryview(buffer)
+    find, step = buffer.find, len(terminator)
+    start = 0
+    try:
+        while True:
+            end = find(terminator, start)
+            if end < 0:
+                if not final or start >= len(buffer): break
+                end = len(buffer)  # last line, without terminator
+            line_start, start = start, end + step
+            if marker is not None:
+                line_start = find(marker, line_start, end)
+                if line_start < 0: continue
+                line_start += len(marker)
+            if line_start < end:
+                stats[0] += 1
+                message = parse_line(view[line_start:end])
+                if message is not None: yield message
+    finally:
+        view.release()
+        stats[1] = start
+
+def _parse_buffer(buffer, terminator, marker):
+    stats, started = [0, 0], time.time()
+    for message in _parse_view(buffer, terminator, marker, True, stats):
+        yield message
+    _log_speed(stats[0], started)
+
+def _parse_file(file, terminator, marker, chunk_size=1 << 20):
+    stats, started = [0, 0], time.time()
+    buffer = bytearray()
+    while True:
+        chunk = file.read(chunk_size)
+        buffer += chunk
+        for message in _parse_view(buffer, terminator, marker, not chunk, stats):
+            yield message
+        del buffer[:stats[1]]  # keep the incomplete last line
+        if not chunk: break
+    _log_speed(stats[0], started)
+
+def _log_speed(lines, started):
+    seconds = max(time.time() - started, 1e-9)
+    logging.info('Parsed {} lines in {:.2f} s ({:.0f} lines/s)'.format(
+                 lines, seconds, lines / seconds))
 
 
 # from: https://tools.ietf.org/html/rfc2812#section-5
@@ -179,6 +482,7 @@ RPL_YOURHOST = 2
 RPL_CREATED = 3
 RPL_MYINFO = 4
 RPL_BOUNCE = 5
+RPL_ISUPPORT = 5  # de facto, see http://www.irc.org/tech_docs/005.html
 RPL_TRACELINK = 200
 RPL_TRACECONNECTING = 201
 RPL_TRACEHANDSHAKE = 202
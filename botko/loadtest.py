@@ -0,0 +1,187 @@
+#!/usr/bin/python
+"""End-to-end load test: a full Bot against a local fake IRC server.
+
+Usage: python loadtest.py [-n LINES] [-r RATE] [-p PLUGINS] [TRAFFIC_FILE]
+
+FakeServer listens on localhost only. It registers the bot (NICK, USER,
+JOIN), then sends it LINES lines of traffic at RATE lines per second
+(or as fast as the bot reads them), repeating TRAFFIC_FILE (see
+benchmark.read_traffic) or benchmark.SAMPLE_TRAFFIC as needed. Numeric
+replies are left out of the traffic so they don't interfere with
+registration. Every so often a 'PING :probe-N' is interleaved. The
+time until the bot's PONG is its reply latency.
+
+Reported are end-to-end throughput (until the PONG of a final probe),
+reply latency percentiles, the bot's own metrics and peak memory.
+Only the ping plugin and those listed with -p are loaded.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+
+import irc
+import botko
+from benchmark import SAMPLE_TRAFFIC, read_traffic
+
+try: import resource
+except ImportError: resource = None  # not on Windows
+
+def max_rss():
+    """Returns peak resident memory of this process, in MiB"""
+    if resource is None: return float('nan')
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024. / (1024 if sys.platform == 'darwin' else 1)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100. * len(values)))] if values else float('nan')
+
+class FakeServer(object):
+    """Speaks just enough RFC 2812 to register one client and join its
+    channels, then feeds it traffic"""
+    def __init__(self, lines, rate=0, probe_every=100, name='fake.server'):
+        self.lines = [line.encode('utf-8') + b'\r\n' for line in lines]
+        self.rate, self.probe_every, self.name = rate, probe_every, name
+        self.nick = None
+        self.received = 0  # lines from the client
+        self.probes = {}  # probe id -> time sent
+        self.latencies = []  # seconds
+        self.joined = asyncio.Event()
+        self._last_probe = None
+        self._done = asyncio.Event()
+        self._writer = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    def close(self):
+        self._server.close()
+
+    def _send(self, line):
+        self._writer.write(line.encode('utf-8') + b'\r\n')
+
+    def _reply(self, code, text):
+        self._send(':{} {:03d} {} {}'.format(self.name, code, self.nick, text))
+
+    async def _handle(self, reader, writer):
+        self._writer = writer
+        registered = False
+        while True:
+            line = await reader.readline()
+            if not line: break
+            self.received += 1
+            message = irc.parse_line(line.rstrip(b'\r\n'))
+            if message is None: continue
+            command = message.command
+            if command == 'nick':
+                self.nick = message.param[0] if message.param else message.text
+            elif command == 'user' and not registered:
+                registered = True
+                self._reply(irc.RPL_WELCOME, ':Welcome to the load test, ' + self.nick)
+                self._reply(irc.RPL_ISUPPORT, 'CHANTYPES=# TARGMAX=PRIVMSG:4,NOTICE:4 '
+                                              ':are supported by this server')
+            elif command == 'join':
+                for channel in message.param[0].split(','):
+                    self._send(':{0}!{0}@localhost JOIN {1}'.format(self.nick, channel))
+                    self._reply(irc.RPL_NAMREPLY, '= {} :{}'.format(channel, self.nick))
+                    self._reply(irc.RPL_ENDOFNAMES, channel + ' :End of /NAMES list.')
+                self.joined.set()
+            elif command == 'pong':
+                probe = message.text or message.param[-1]
+                sent = self.probes.pop(probe, None)
+                if sent is not None:
+                    self.latencies.append(time.perf_counter() - sent)
+                    if probe == self._last_probe: self._done.set()
+            elif command == 'quit':
+                break
+        writer.close()
+
+    def _probe(self):
+        probe = 'probe-{}'.format(len(self.probes) + len(self.latencies))
+        self.probes[probe] = time.perf_counter()
+        self._send('PING :' + probe)
+        return probe
+
+    async def feed(self, count, timeout=60):
+        """Sends count lines of traffic; returns seconds until the
+        client answered the last of them"""
+        await self.joined.wait()
+        writer, lines, rate = self._writer, self.lines, self.rate
+        started = time.perf_counter()
+        for i in range(count):
+            if self.probe_every and not i % self.probe_every: self._probe()
+            writer.write(lines[i % len(lines)])
+            if rate and not i % 10:
+                delay = started + i / rate - time.perf_counter()
+                if delay > 0: await asyncio.sleep(delay)
+            elif not i % 100:
+                await writer.drain()
+        self._last_probe = self._probe()
+        await asyncio.wait_for(self._done.wait(), timeout)
+        return time.perf_counter() - started
+
+def plugin_names():
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plugins')
+    for filename in sorted(os.listdir(directory)):
+        name, extension = os.path.splitext(filename)
+        if not name.startswith('_') and extension == '.py':
+            yield name
+
+async def run(lines, count, rate=0, plugins=(), probe_every=100):
+    server = FakeServer(lines, rate, probe_every)
+    port = await server.start()
+    config = {'main': {'server': '127.0.0.1', 'port': str(port),
+                       'nick': 'botko', 'nickname': 'botko', 'real_name': 'botko',
+                       'channels': '#loadtest',
+                       'data_dir': tempfile.mkdtemp(prefix='botko-loadtest-'),
+                       'flood_burst': '1000000', 'flood_rate': '1000000'}}
+    for name in plugin_names():
+        if name != 'ping' and name not in plugins:
+            config[name] = {'disabled': '1'}
+    rss = max_rss()
+    bot = botko.Bot(config)
+    task = asyncio.ensure_future(bot.start())
+    try:
+        seconds = await server.feed(count)
+    finally:
+        task.cancel()
+        try: await task
+        except asyncio.CancelledError: pass
+        server.close()
+
+    metrics = bot.metrics
+    print('Fed {} lines in {:.2f} s: {:.0f} lines/s'.format(count, seconds, count / seconds))
+    latencies = server.latencies
+    print('Reply latency ({} probes): p50 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms'.format(
+          len(latencies), percentile(latencies, 50) * 1e3,
+          percentile(latencies, 99) * 1e3, max(latencies) * 1e3))
+    print('Bot received {} lines, sent {}; parse {:.2f} us/line, dispatch {:.2f} us/line'.format(
+          metrics.rx_lines_total, metrics.tx_lines_total,
+          metrics.parse_seconds_total / metrics.rx_lines_total * 1e6,
+          metrics.dispatch_seconds_total / metrics.rx_lines_total * 1e6))
+    print('Peak memory: {:.1f} MiB ({:+.1f} MiB during the test)'.format(max_rss(), max_rss() - rss))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('traffic', nargs='?', metavar='TRAFFIC_FILE')
+    parser.add_argument('-n', '--lines', type=int, default=100000)
+    parser.add_argument('-r', '--rate', type=float, default=0,
+                        help='lines per second (default: as fast as possible)')
+    parser.add_argument('-p', '--plugins', default='',
+                        help='comma-separated plugins to load besides ping')
+    parser.add_argument('--probe-every', type=int, default=100, metavar='LINES')
+    args = parser.parse_args()
+    lines = read_traffic(args.traffic) if args.traffic else SAMPLE_TRAFFIC
+    lines = [line for line in lines if not getattr(irc.parse_line(line), 'code', True)]
+    botko.init_logging(logging.WARNING)
+    asyncio.run(run(lines, args.lines, args.rate, args.plugins.split(','), args.probe_every))
+
+
+if __name__ == '__main__':
+    main()
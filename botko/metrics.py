@@ -0,0 +1,84 @@
+"""Wire and pipeline metrics in Prometheus text exposition format.
+
+Counters are plain attributes of a Metrics object, incremented in
+place on the hot paths. Gauges (and counters kept elsewhere) are
+registered as callables and read when rendering. The result can be
+written to a file (e.g. for node_exporter's textfile collector) or
+served over HTTP on a local port.
+
+>>> metrics = Metrics()
+>>> metrics.rx_lines_total += 2
+>>> metrics.gauge('queue_depth', 'Lines waiting', lambda: 3)
+>>> print(metrics.render())  # doctest: +ELLIPSIS
+# HELP botko_rx_lines_total Lines received
+# TYPE botko_rx_lines_total counter
+botko_rx_lines_total 2
+...
+# HELP botko_queue_depth Lines waiting
+# TYPE botko_queue_depth gauge
+botko_queue_depth 3
+<BLANKLINE>
+"""
+
+import os
+import asyncio
+import logging
+
+log = logging.getLogger()
+
+COUNTERS = (
+    ('rx_lines_total', 'Lines received'),
+    ('rx_bytes_total', 'Bytes received'),
+    ('tx_lines_total', 'Lines sent'),
+    ('tx_bytes_total', 'Bytes sent'),
+    ('parse_seconds_total', 'Time spent parsing received lines'),
+    ('dispatch_seconds_total', 'Time spent dispatching received lines to handlers'),
+    ('connections_total', 'Connections established'),
+    ('reconnects_total', 'Connections established after the first'),
+)
+
+class Metrics(object):
+    __slots__ = tuple(name for name, _ in COUNTERS) + ('prefix', '_gauges')
+
+    def __init__(self, prefix='botko_'):
+        for name, _ in COUNTERS: setattr(self, name, 0)
+        self.prefix = prefix
+        self._gauges = []  # (name, help, type, func)
+
+    def gauge(self, name, help, func, type='gauge'):
+        """Registers func() as the value of metric name"""
+        self._gauges.append((name, help, type, func))
+
+    def render(self):
+        lines = []
+        metrics = [(name, help, 'counter', getattr(self, name)) for name, help in COUNTERS]
+        metrics += [(name, help, type, func()) for name, help, type, func in self._gauges]
+        for name, help, type, value in metrics:
+            name = self.prefix + name
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, type))
+            lines.append('{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        """Writes the metrics to filename, atomically"""
+        with open(filename + '.tmp', 'w') as f:
+            f.write(self.render())
+        os.replace(filename + '.tmp', filename)
+
+    async def serve(self, port, host='127.0.0.1'):
+        """Serves the metrics over HTTP on host:port; returns asyncio.Server"""
+        async def handle(reader, writer):
+            try:
+                while (await asyncio.wait_for(reader.readline(), 5)).strip():
+                    pass  # skip request line and headers
+                body = self.render().encode('utf-8')
+                writer.write(b'HTTP/1.0 200 OK\r\n'
+                             b'Content-Type: text/plain; version=0.0.4\r\n'
+                             b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+                await writer.drain()
+            except (asyncio.TimeoutError, ConnectionError): pass
+            finally: writer.close()
+        server = await asyncio.start_server(handle, host, port)
+        log.info('Serving metrics on http://{}:{}/'.format(host, port))
+        return server
@@ -23,8 +23,9 @@ Additionally, these events are defined:
 
 Additionally, callbacks can be of the regex form:
 * on_([0-9]+) - called when \1 code is received (defined in botko.irc),
-* on_every_([0-9]+)([smhd]) - called in a separate thread on every \1
-                            units (\2: Seconds, Minutes, Hours, Days),
+* on_every_([0-9]+)([smhd]) - called on every \1 units (\2: Seconds,
+                            Minutes, Hours, Days), starting once the
+                            channels are joined,
 
 E.g.
 
@@ -32,6 +33,39 @@ E.g.
   def on_every_30m(bot, _): pass  # called about every 30 minutes
 
 
+Functions named cmd_* handle commands addressed to the bot, e.g.
+'botko: karma kernc' (or just 'karma kernc' in a private message):
+
+  def cmd_karma(bot, message, args):  # args == ['kernc']
+      '''Shows karma stats'''  # the first line is the help text
+  cmd_karma.aliases = ('upvotes', 'leaderboard')
+  cmd_karma.usage = '[nick]'
+
+Commands can be abbreviated as long as that stays unambiguous. The
+built-in 'help' command lists them all.
+
+A handler can declare which messages it wants with attributes:
+
+  on_chanmsg.channels = ('#botko',)  # or a comma-separated str
+  on_chanmsg.prefix = '!'  # text starts with (a str or tuple of str)
+  on_chanmsg.contains = '://'  # text contains, ignoring case (str or tuple)
+  on_chanmsg.regex = re.compile('https?://')  # text matches
+
+It is then only called for messages that meet all of them. The bot
+matches the regexes of all plugins in one scan of each message, once
+the other conditions are met, so they are a cheap way to skip it. The
+attributes can also be set (or changed) in on_load.
+
+Handlers that block (on disk or network I/O, long computation, ...)
+should be listed in a module-level __blocking__, e.g.
+
+  __blocking__ = ('on_chanmsg', 'on_every_30m')  # or True, for all
+
+These run on a thread pool, one at a time per plugin, in the order the
+events came in. One that takes longer than the plugin's
+handler_timeout config (main/handler_timeout by default) is logged and
+abandoned. on_load and on_unload always run in place.
+
 All callbacks take two arguments:
 * botko.Botko instance - the bot, and
 * botko.irc.Message (usually) or None (on load, unload, every, ...)
@@ -40,6 +74,9 @@ In plugins, you can also use:
 * bot.log - an instance of logging.Logger,
 * bot.config - a botko.Config instance,
 * bot.privmsg(), bot.notice() - to send messages,
+* bot.reply() - to reply to a message in its channel or privately,
+* bot.call_later(), bot.call_every() - to schedule (one-shot or
+  periodic) callbacks,
 * ... - see botko.Botko for further info.
 
 Inspect other provided examples.
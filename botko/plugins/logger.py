@@ -1,6 +1,31 @@
+"""Logs channels and private conversations to text files.
+
+Lines are handed to a LogWriter thread, which batches them and writes
+to $logdir/$server/$channel_or_person/$timestamp.log, so the event
+loop never waits on the disk. Logs are rotated daily and/or once they
+grow to a set size, and rotated logs are gzipped on another thread.
+
+Next to each log, a .idx file maps times to byte offsets: a line
+'<unix time> <offset>' for the first line logged in each minute. In a
+gzipped log, each indexed offset starts a gzip member (of about 64 KiB
+of text), so read_log() can seek straight to the part it needs.
+
+Unless disabled, the words of each logged line are added to a LogIndex,
+searched with the grep command.
+"""
 
 import os
-from datetime import datetime
+import re
+import time
+import gzip
+import sqlite3
+from datetime import datetime, timedelta
+from threading import Thread, local
+from itertools import islice
+from collections import OrderedDict, defaultdict
+from queue import Queue, Empty
+
+import irc
 
 def mkdir_p(path):
     try: os.makedirs(path)
@@ -8,56 +33,524 @@ def mkdir_p(path):
         if os.path.isdir(path): pass
         else: raise
 
-class logger(object):
-    def __init__(self, bot):
-        self.bot = bot
-        self.files = {}
-        self.chans = bot.config('logger/channels')
-        self.convs = bot.config('logger/conversations')
-        bot.log.info('Logging: {} channels and conversations with {}'.format(self.chans, self.convs))
-        self.chans = True if chans.lower() == 'all' else chans.split(',')
-        self.convs = True if convs.lower() == 'all' else convs.split(',')
-    
-    def has_log_targets(self):
-        return self.chans or self.convs
-
-    def log(self, bot, nick, target, text):
-        if target.startswith(('#', '&', '!')):
-            if self.chans == True or target in self.chans:
-                self.write(nick, target, text)
-        else:
-            if self.convs == True or nick in self.convs:
-                self.write(nick, nick, text)
-
-    def write(self, nick, target, text):
-        if target not in self.files:
-            file = '{}/{}/{target}/{date}.txt'.format(
-                *bot.config('main/log_dir', 'main/server'),
-                target=target,
-                date=datetime.isoformat(datetime.now()))
-            self.bot.log.debug('Opening new log file: ' + file)
-            mkdir_p(os.path.dirname(file))
-            self.files[target] = open(file, 'a')
-            # TODO: write some kind of header?
-        line = '{time} {nick}: {text}'.format(datetime.now(), nick, text)
-        self.files[target].write(line)
-
-
-def on_load(bot, _):
-    global logger
-    logger = logger(bot)
-    if not logger.has_log_targets(): return
+def _read_index(path):
+    """Returns [(unix time, offset)] from an index file, or []"""
+    try:
+        with open(path) as f:
+            return [tuple(map(int, line.split())) for line in f if line.strip()]
+    except (OSError, IOError): return []
+
+def _next_midnight(when):
+    day = datetime.fromtimestamp(when).date() + timedelta(days=1)
+    return time.mktime(day.timetuple())
+
+def _parse_size(size):
+    """'100M' -> 104857600"""
+    scale = 1024 ** ('KMG'.index(size[-1].upper()) + 1) if size[-1].upper() in 'KMG' else 1
+    return int(float(size.rstrip('kKmMgG')) * scale)
+
+def _encode_deltas(offsets, last=0):
+    """Encodes ascending ints as varints of their differences (the
+    first one's from last)"""
+    data = bytearray()
+    for offset in offsets:
+        delta, last = offset - last, offset
+        while delta >= 0x80:
+            data.append(delta & 0x7f | 0x80)
+            delta >>= 7
+        data.append(delta)
+    return bytes(data)
+
+def _decode_deltas(data):
+    offsets, value, shift, last = [], 0, 0, 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        last += value
+        offsets.append(last)
+        value = shift = 0
+    return offsets
+
+class LogIndex(object):
+    """An inverted index of logged lines, in SQLite. For each word and
+    log file, it keeps the offsets of the lines with the word, as
+    varint-encoded differences, in rows of up to about ROW_BYTES each;
+    each commit appends to the last one. Added to from the LogWriter
+    thread, searched from any thread."""
+    WORD = re.compile(r'\w{2,}')
+    MAX_WORDS = 64  # indexed per line, to bound the work
+    ROW_BYTES = 512
+    MAX_TAILS = 65536  # last rows remembered, so appending needn't read them
+
+    def __init__(self, path, directory):
+        self.path, self.directory = path, directory
+        self._local = local()  # a connection per thread
+        self._files = {}  # log path -> file id
+        self._pending = defaultdict(list)  # (word, file id) -> offsets
+        self._tails = OrderedDict()  # (word, file id) -> [start, bytes, last offset] of the last row
+        self._db().executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                target TEXT NOT NULL,
+                path TEXT UNIQUE NOT NULL);  -- relative to directory
+            CREATE TABLE IF NOT EXISTS postings (
+                word TEXT NOT NULL,
+                file INTEGER NOT NULL,
+                start INTEGER NOT NULL,  -- the first offset
+                offsets BLOB NOT NULL,
+                PRIMARY KEY (word, file, start)) WITHOUT ROWID;
+        ''')
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path)
+            db.execute('PRAGMA journal_mode=WAL')  # searches don't block adds
+        return db
+
+    def words(self, text):
+        return {match.group() for match in islice(self.WORD.finditer(text.lower()), self.MAX_WORDS)}
+
+    def add(self, target, path, offset, text):
+        """Indexes the line at offset of log path; see commit()"""
+        file = self._files.get(path)
+        if file is None:
+            db, relpath = self._db(), os.path.relpath(path, self.directory)
+            db.execute('INSERT OR IGNORE INTO files (target, path) VALUES (?, ?)', (target, relpath))
+            file = self._files[path] = db.execute('SELECT id FROM files WHERE path = ?',
+                                                  (relpath,)).fetchone()[0]
+        for word in self.words(text):
+            self._pending[word, file].append(offset)
+
+    def commit(self):
+        """Stores the lines added since the last commit"""
+        if not self._pending: return
+        db, tails = self._db(), self._tails
+        with db:
+            for key, offsets in self._pending.items():
+                tail = tails.pop(key, None)
+                if tail is None:
+                    row = db.execute('SELECT start, offsets FROM postings WHERE word = ? AND file = ? '
+                                     'ORDER BY start DESC LIMIT 1', key).fetchone()
+                    if row: tail = [row[0], len(row[1]), _decode_deltas(row[1])[-1]]
+                if tail is not None and tail[1] < self.ROW_BYTES:
+                    data = _encode_deltas(offsets, tail[2])
+                    db.execute('UPDATE postings SET offsets = CAST(offsets || ? AS BLOB) '
+                               'WHERE word = ? AND file = ? AND start = ?', (data,) + key + (tail[0],))
+                    tail[1] += len(data)
+                else:
+                    data = _encode_deltas(offsets)
+                    db.execute('INSERT INTO postings VALUES (?, ?, ?, ?)', key + (offsets[0], data))
+                    tail = [offsets[0], len(data), None]
+                tail[2] = offsets[-1]
+                tails[key] = tail
+                if len(tails) > self.MAX_TAILS: tails.popitem(last=False)
+        self._pending.clear()
+
+    def _offsets(self, word, file):
+        offsets = set()
+        for blob, in self._db().execute('SELECT offsets FROM postings WHERE word = ? AND file = ?',
+                                        (word, file)):
+            offsets.update(_decode_deltas(blob))
+        return offsets
+
+    def search(self, words, target=None, limit=None):
+        """Yields (target, log path, offset) of up to limit channel lines
+        with all words, in target only, if given; newest first. Only the
+        files with the rarest word are looked at, one at a time."""
+        words, db = self.words(' '.join(words)), self._db()
+        if not words: return
+        files = {id: (target, os.path.join(self.directory, path)) for id, target, path in db.execute(
+            "SELECT id, target, path FROM files WHERE target = ? OR "
+            "(? IS NULL AND substr(target, 1, 1) IN ({}))".format(', '.join('?' * len(irc.CHANNEL_PREFIXES))),
+            (target, target) + irc.CHANNEL_PREFIXES)}
+        batches = {word: db.execute('SELECT count(*) FROM postings WHERE word = ?', (word,)).fetchone()[0]
+                   for word in words}
+        rarest = min(words, key=batches.get)
+        others = sorted(words - {rarest}, key=batches.get)
+        found = 0
+        for file, in db.execute('SELECT DISTINCT file FROM postings WHERE word = ? ORDER BY file DESC',
+                                (rarest,)).fetchall():
+            if file not in files: continue
+            offsets = self._offsets(rarest, file)
+            for word in others:
+                if not offsets: break
+                offsets &= self._offsets(word, file)
+            for offset in sorted(offsets, reverse=True):
+                yield files[file] + (offset,)
+                found += 1
+                if found == limit: return
+
+class _Log(object):
+    """The state of one target's current log file"""
+    __slots__ = ('path', 'size', 'rotate_at', 'minute', 'lines', 'index')
+
+    def __init__(self):
+        self.path = None
+        self.size = 0  # bytes, including those not yet written
+        self.rotate_at = 0  # unix time
+        self.minute = None  # of the last index entry
+        self.lines = []  # encoded lines to write
+        self.index = []  # index lines to write
+
+class LogWriter(Thread):
+    """Writes queued lines to per-target log files, in batches.
+
+    A batch is written once it holds flush_bytes, or flush_interval
+    seconds after its first line. At most max_open files are kept open;
+    the least recently written one is closed to make room. A log is
+    rotated at midnight if rotate_daily, and once it reaches rotate_size
+    bytes, if set; rotated logs are passed to compressor, if any. The
+    lines' texts are added to index, if any.
+    """
+    def __init__(self, directory, rotate_daily=True, rotate_size=None, compressor=None,
+                 index=None, max_open=64, flush_bytes=64*1024, flush_interval=1.):
+        Thread.__init__(self, name='logger')
+        self.daemon = True
+        self.directory = directory
+        self.rotate_daily, self.rotate_size, self.compressor = rotate_daily, rotate_size, compressor
+        self.index = index
+        self.max_open, self.flush_bytes, self.flush_interval = max_open, flush_bytes, flush_interval
+        self.queue = Queue()
+        self.logs = {}  # target -> _Log
+        self.files = OrderedDict()  # target -> open file, least recently used first
+        self._dirty = set()  # targets with lines to write
+        self._pending_bytes = 0
+
+    def write(self, target, when, line, text=''):
+        """Queues line (ending with a newline), logged at unix time when,
+        for target's log, and its text for the index; thread-safe"""
+        self.queue.put((target, when, line, text))
+
+    def close(self, timeout=None):
+        """Writes out the queued lines, closes all files and stops"""
+        self.queue.put(None)
+        self.join(timeout)
+
+    def target_directory(self, target):
+        return os.path.join(self.directory, target.replace(os.sep, '_'))
+
+    def run(self):
+        deadline = None  # when the pending batch is due
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try: item = self.queue.get(timeout=timeout)
+            except Empty: item = ()
+            if item:
+                self._add(*item)
+                if deadline is None: deadline = time.monotonic() + self.flush_interval
+                if self._pending_bytes < self.flush_bytes and time.monotonic() < deadline:
+                    continue
+            self._flush()
+            deadline = None
+            if item is None: break
+        for file in self.files.values(): file.close()
+        self.files.clear()
+
+    def _add(self, target, when, line, text):
+        log = self.logs.get(target)
+        if log is None: log = self.logs[target] = _Log()
+        if (log.path is None or when >= log.rotate_at or
+                self.rotate_size and log.size >= self.rotate_size):
+            self._rotate(target, log, when)
+        minute = int(when // 60)
+        if minute != log.minute:
+            log.minute = minute
+            log.index.append('{} {}\n'.format(int(when), log.size))
+        if self.index is not None and text:
+            self.index.add(target, log.path, log.size, text)
+        data = line.encode('utf-8')
+        log.lines.append(data)
+        log.size += len(data)
+        self._pending_bytes += len(data)
+        self._dirty.add(target)
+
+    def _rotate(self, target, log, when):
+        if log.path is not None:
+            self._write(target, log)
+            file = self.files.pop(target, None)
+            if file is not None: file.close()
+            if self.compressor is not None: self.compressor.compress(log.path)
+        directory = self.target_directory(target)
+        mkdir_p(directory)
+        name = datetime.fromtimestamp(when).strftime('%Y-%m-%dT%H%M%S')
+        path, n = os.path.join(directory, name + '.log'), 0
+        while os.path.exists(path) or os.path.exists(path + '.gz'):  # rotated within a second
+            n += 1
+            path = os.path.join(directory, '{}-{}.log'.format(name, n))
+        bot.log.debug('Opening new log file: ' + path)
+        log.path, log.size, log.minute = path, 0, None
+        log.rotate_at = _next_midnight(when) if self.rotate_daily else float('inf')
+
+    def _flush(self):
+        for target in self._dirty:
+            self._write(target, self.logs[target])
+        self._dirty.clear()
+        self._pending_bytes = 0
+        if self.index is not None:  # after the lines it points to
+            try: self.index.commit()
+            except sqlite3.Error as exc: bot.log.error('Could not update log index: {}'.format(exc))
+
+    def _write(self, target, log):
+        try:
+            if log.lines:
+                file = self._open(target, log.path)
+                file.write(b''.join(log.lines))
+                file.flush()
+            if log.index:  # after the lines it points to
+                with open(log.path + '.idx', 'a') as index:
+                    index.write(''.join(log.index))
+        except (OSError, IOError) as exc:
+            bot.log.error('Could not write {} lines to {}: {}'.format(len(log.lines), log.path, exc))
+        log.lines, log.index = [], []
+
+    def _open(self, target, path):
+        file = self.files.get(target)
+        if file is not None:
+            self.files.move_to_end(target)
+            return file
+        if len(self.files) >= self.max_open:
+            self.files.popitem(last=False)[1].close()
+        file = self.files[target] = open(path, 'ab')
+        return file
+
+class Compressor(Thread):
+    """Gzips rotated logs, one at a time, see compress_log()"""
+    def __init__(self, block_size=64*1024):
+        Thread.__init__(self, name='logger-gzip')
+        self.daemon = True
+        self.block_size = block_size
+        self.queue = Queue()
+
+    def compress(self, path):
+        self.queue.put(path)
+
+    def close(self, timeout=None):
+        """Stops after the current log; the rest are left uncompressed
+        (and get compressed on the next load)"""
+        while True:
+            try: self.queue.get_nowait()
+            except Empty: break
+        self.queue.put(None)
+        self.join(timeout)
+
+    def run(self):
+        for path in iter(self.queue.get, None):
+            try: compress_log(path, self.block_size)
+            except (OSError, IOError) as exc:
+                bot.log.error('Could not compress {}: {}'.format(path, exc))
+
+def compress_log(path, block_size=64*1024):
+    """Gzips log path to path.gz, indexed in path.gz.idx, then removes
+    path and path.idx. Each gzip member holds about block_size bytes of
+    lines and starts at one of the minutes indexed in path.idx; the
+    index lists its time, its offset and its offset in path."""
+    index = _read_index(path + '.idx') or [(0, 0)]
+    if index[0][1]: index.insert(0, (index[0][0], 0))
+    ends = [offset for _, offset in index[1:]] + [os.path.getsize(path)]
+    members, block, block_bytes, block_time, block_start = [], [], 0, 0, 0
+    with open(path, 'rb') as src, open(path + '.gz.tmp', 'wb') as dst:
+        def write_block():
+            members.append('{} {} {}\n'.format(block_time, dst.tell(), block_start))
+            dst.write(gzip.compress(b''.join(block)))
+        for (when, start), end in zip(index, ends):
+            if block_bytes >= block_size:
+                write_block()
+                block, block_bytes = [], 0
+            if not block: block_time, block_start = when, start
+            block.append(src.read(end - start))
+            block_bytes += end - start
+        if block: write_block()
+    with open(path + '.gz.idx.tmp', 'w') as f:
+        f.write(''.join(members))
+    os.replace(path + '.gz.tmp', path + '.gz')
+    os.replace(path + '.gz.idx.tmp', path + '.gz.idx')
+    os.remove(path)
+    if os.path.exists(path + '.idx'): os.remove(path + '.idx')
+
+def read_log(path, since=0, until=None):
+    """Yields the lines of log file path (.log or .log.gz) logged from
+    unix time since to until, seeking to since by the file's index"""
+    offset = 0
+    for entry in _read_index(path + '.idx'):
+        if entry[0] > since: break
+        offset = entry[1]
+    since = datetime.fromtimestamp(since).isoformat()[:19]
+    until = until and datetime.fromtimestamp(until).isoformat()[:19]
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in (gzip.GzipFile(fileobj=f) if path.endswith('.gz') else f):
+            stamp = line[:19].decode('ascii', 'replace')
+            if until and stamp >= until: break
+            if stamp >= since: yield line.decode('utf-8', 'replace').rstrip('\n')
+
+def read_line_at(path, offset):
+    """Returns the line at offset of log path, also once it's gzipped
+
+    >>> import sys, logging, tempfile
+    >>> sys.modules[LogWriter.__module__].bot = type('Bot', (), {'log': logging.getLogger()})
+    >>> writer = LogWriter(tempfile.mkdtemp(), rotate_daily=False, rotate_size=100)
+    >>> writer.start()
+    >>> for i in range(6):  # a minute apart, 30 bytes each
+    ...     when = 1e9 + 60 * i
+    ...     stamp = datetime.fromtimestamp(when).isoformat()[:19]
+    ...     writer.write('#a', when, '{} x: line {}\\n'.format(stamp, i))
+    >>> writer.close()
+    >>> directory = writer.target_directory('#a')
+    >>> first, second = sorted(os.path.join(directory, name)
+    ...                        for name in os.listdir(directory) if name.endswith('.log'))
+    >>> compress_log(first, block_size=40)  # as Compressor does once it's rotated
+    >>> sorted(os.path.splitext(name)[1] for name in os.listdir(directory))
+    ['.gz', '.idx', '.idx', '.log']
+    >>> with open(first + '.gz.idx') as index: len(index.readlines())  # gzip members
+    2
+    >>> [read_line_at(first, offset)[20:] for offset in (0, 30, 90)]
+    ['x: line 0', 'x: line 1', 'x: line 3']
+    >>> read_line_at(second, 30)[20:]
+    'x: line 5'
+    """
+    try:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            line = f.readline()
+    except (OSError, IOError):
+        path += '.gz'
+        member = start = 0
+        for entry in _read_index(path + '.idx'):
+            if entry[2] > offset: break
+            member, start = entry[1], entry[2]
+        with open(path, 'rb') as f:
+            f.seek(member)
+            text = gzip.GzipFile(fileobj=f)
+            text.read(offset - start)
+            line = text.readline()
+    return line.decode('utf-8', 'replace').rstrip('\n')
+
+def log_files(directory):
+    """Returns the names of the log files in directory, oldest first:
+    by start time, then by the number of those rotated within a second
+
+    >>> sorted(['2016-01-31T120000-10.log', '2016-01-31T120000-2.log.gz',
+    ...         '2016-01-31T120000.log.gz'], key=_log_order)  # doctest: +NORMALIZE_WHITESPACE
+    ['2016-01-31T120000.log.gz', '2016-01-31T120000-2.log.gz',
+     '2016-01-31T120000-10.log']
+    """
+    return sorted((name for name in os.listdir(directory) if name.endswith(('.log', '.log.gz'))),
+                  key=_log_order)
+
+def _log_order(name):
+    number = name[17:].partition('.')[0]
+    return name[:17], int(number[1:] or 0)
+
+def read_target_log(target, since=0, until=None):
+    """Yields the lines logged for target (a channel or nick) from unix
+    time since to until, across its log files"""
+    directory = writer.target_directory(target.lower())
+    try: names = log_files(directory)
+    except OSError: return
+    starts = [time.mktime(time.strptime(name[:17], '%Y-%m-%dT%H%M%S')) for name in names]
+    for i, name in enumerate(names):
+        if until and starts[i] >= until: break
+        if i + 1 < len(names) and starts[i + 1] <= since: continue
+        for line in read_log(os.path.join(directory, name), since, until): yield line
+
+def _targets(option):
+    """Returns True for 'all', else the set of comma-separated targets"""
+    option = bot.config('logger/' + option)
+    return True if option.lower() == 'all' else set(option.lower().split(',')) - {''}
+
+def log(nick, target, text):
+    if target.startswith(irc.CHANNEL_PREFIXES):
+        if channels is not True and target.lower() not in channels: return
+    else:
+        if conversations is not True and target.lower() not in conversations: return
+    when = time.time()
+    stamp = datetime.fromtimestamp(when).isoformat()[:19]
+    if text.startswith('\x01ACTION ') and text.endswith('\x01'):
+        line = '{} * {} {}\n'.format(stamp, nick, text[8:-1])
+    else:
+        line = '{} {}: {}\n'.format(stamp, nick, text)
+    writer.write(target.lower(), when, line, nick + ' ' + text)
+
+def _parse_since(arg):
+    """Returns the unix time of e.g. '3d' (ago) or '2016-01-31', or None"""
+    match = re.match(r'^(\d+)([hdw])$', arg)
+    if match:
+        return time.time() - int(match.group(1)) * {'h': 3600, 'd': 86400, 'w': 7*86400}[match.group(2)]
+    try: return time.mktime(time.strptime(arg, '%Y-%m-%d'))
+    except ValueError: return None
+
+def cmd_grep(bot, message, args):
+    """Shows the newest logged channel lines with all the words"""
+    if index is None: return bot.reply(message, 'The logs are not indexed')
+    channel = next((arg for arg in args if arg.startswith(irc.CHANNEL_PREFIXES)), None)
+    since = _parse_since(args[-1]) if args else None
+    words = [arg for arg in (args[:-1] if since else args) if arg != channel]
+    if not index.words(' '.join(words)): return bot.reply(message, 'Usage: ' + cmd_grep.usage)
+    here = message.param[0] if message.param[0].startswith(irc.CHANNEL_PREFIXES) else None
+    channel = channel or here
+    if bot.config.get('logger/grep_access') != 'all' and (not here or channel.lower() != here.lower()):
+        return bot.reply(message, 'I only search the logs of the channel asked in')
+    since = datetime.fromtimestamp(since or 0).isoformat()[:19]
+    found = 0
+    for target, path, offset in index.search(words, channel and channel.lower(), 3):
+        try: line = read_line_at(path, offset)
+        except (OSError, IOError): continue
+        if line[:19] < since: break
+        bot.reply(message, '{} {}'.format(target, line))
+        found += 1
+    if not found: bot.reply(message, 'Nothing found')
+cmd_grep.aliases = ('search',)
+cmd_grep.usage = '<words> [#channel] [since, e.g. 3d or 2016-01-31]'
+
+__blocking__ = ('cmd_grep',)
+
+def on_load(_bot, _):
+    global bot, writer, compressor, index, channels, conversations
+    bot = _bot
+    channels, conversations = _targets('channels'), _targets('conversations')
+    bot.log.info('Logging: {} channels and conversations with {}'.format(channels, conversations))
+    if not (channels or conversations): return
+    directory = os.path.join(bot.config.get('logger/logdir') or './logs/', bot.config('main/server'))
+    rotate = bot.config.get('logger/rotate', 'daily').lower().split(',')
+    if bot.config.get('logger/compress', 'gzip'):
+        compressor = Compressor()
+        for root, _, files in os.walk(directory):  # logs of previous runs
+            for name in sorted(files):
+                if name.endswith('.log'): compressor.compress(os.path.join(root, name))
+        compressor.start()
+    if bot.config.get('logger/index', 'yes'):
+        mkdir_p(directory)
+        index = LogIndex(os.path.join(directory, 'index.sqlite'), directory)
+    writer = LogWriter(directory, 'daily' in rotate,
+                       next((_parse_size(size) for size in rotate if size[:1].isdigit()), None),
+                       compressor, index,
+                       int(bot.config.get('logger/max_open_files') or 64),
+                       int(bot.config.get('logger/flush_bytes') or 64*1024),
+                       float(bot.config.get('logger/flush_interval') or 1))
+    writer.start()
+    bot.read_log = read_target_log
     # Monkey-patch bot.privmsg() so it logs self-output
     orig_privmsg = bot.privmsg
     def monkey_privmsg(target, text):
         for t in target.split(','):
-            logger.log(bot, bot.nick, t, text)
+            log(bot.nick, t, text)
         orig_privmsg(target, text)
     bot.log.info('Monkey-patching bot.privmsg()')
     bot.privmsg = monkey_privmsg
-    # Set on_privmsg handler
-    def privmsg(bot, message):
-        logger.log(bot, message.nick, message.param[0], message.text)
-    global on_privmsg
-    on_privmsg = privmsg
 
+def on_privmsg(bot, message):
+    if writer is None: return
+    target = message.param[0]
+    log(message.nick, target if target.startswith(irc.CHANNEL_PREFIXES) else message.nick,
+        message.text)
+
+def on_unload(bot, _):
+    if writer is not None: writer.close()
+    if compressor is not None: compressor.close(timeout=10)
+
+writer = None  # a LogWriter, once loaded with anything to log
+compressor = None  # a Compressor, unless disabled
+index = None  # a LogIndex, unless disabled
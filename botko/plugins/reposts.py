@@ -1,10 +1,18 @@
-__depends__ = 'serializer'  # TODO: implement this, I think
+__depends__ = 'serializer'
 
+import os
 import re
-from collections import defaultdict, OrderedDict
-from operator import itemgetter
+import math
+import time
+import sqlite3
+from hashlib import blake2b
+from collections import OrderedDict
 from datetime import datetime
 from random import choice
+from urllib.parse import urlsplit
+
+import irc
+from plugins.serializer import SerializationError
 
 REPOSTS = (
     "I don't want to be rude {nick}, but {repostNick} has already posted this link!",
@@ -34,52 +42,291 @@ SELF_REPOSTS = (
     "{nick}, I'd like to congratulate you on your original link... but you've posted it here before.",
 )
 
-def _trim_history(tracked, maxlen, channels):
-    for chan in tuple(tracked):
-        if not (chan in channels or channels is None):
-            del tracked[chan]
-            continue
-        if len(tracked[chan]) > maxlen:
-            remove_len = len(tracked[chan]) - maxlen
-            remove_keys = []
-            for key in tracked[chan]:
-                if remove_len == 0: break
-                remove_keys.append(key)
-                remove_len -= 1
-            for key in remove_keys:
-                del tracked[chan][key]
+TRACKING_PARAM = re.compile(r'^(utm_\w+|fbclid|gclid|dclid|msclkid|yclid|igshid|mc_[ce]id|_ga|ref_?src)$', re.I)
+
+def normalize_link(link):
+    """Returns link without the parts that don't tell links apart: the
+    scheme, 'www.', trailing slashes and tracking query parameters
+
+    >>> normalize_link('HTTPS://www.Example.com/Some/Path/?utm_source=x&id=2#')
+    'example.com/Some/Path?id=2'
+    >>> normalize_link('www.example.com') == normalize_link('http://example.com/')
+    True
+    """
+    if '://' not in link: link = 'http://' + link
+    try: parts = urlsplit(link)
+    except ValueError: return link  # e.g. a broken IPv6 address
+    host = parts.netloc.lower()
+    if host.startswith('www.'): host = host[4:]
+    query = '&'.join(param for param in parts.query.split('&')
+                     if param and not TRACKING_PARAM.match(param.split('=', 1)[0]))
+    return (host + parts.path.rstrip('/') +
+            ('?' + query if query else '') +
+            ('#' + parts.fragment if parts.fragment else ''))
+
+class LinkHistory(OrderedDict):
+    """A channel's links, least recently posted first. Setting a link
+    makes it the most recent one; past maxlen links, the least recent
+    one is evicted.
+
+    >>> history = LinkHistory(2)
+    >>> history['a'] = history['b'] = 1
+    >>> history['a'] = history['c'] = 2
+    >>> list(history.items())
+    [('a', 2), ('c', 2)]
+    """
+    maxlen = 1000
+
+    def __init__(self, maxlen=None):
+        OrderedDict.__init__(self)
+        if maxlen is not None: self.maxlen = maxlen
+
+    def __setitem__(self, link, value):
+        OrderedDict.__setitem__(self, link, value)
+        self.move_to_end(link)
+        while len(self) > self.maxlen: self.popitem(last=False)
+
+class Tracked(dict):
+    """The LinkHistory of each channel"""
+    def __missing__(self, channel):
+        links = self[channel] = LinkHistory()
+        return links
+
+def _apply(tracked, record):
+    """Applies a journal record of a link (re)posted"""
+    channel, link, entry = record
+    channel = channel.lower()  # as channels are case-insensitive
+    if tracked_channels is None or channel in tracked_channels:
+        tracked[channel][link] = entry
+
+class MemoryStore(object):
+    """The recently posted links of each channel (see LinkHistory), in
+    memory, journaled (see serializer.Journal). Channels are lowercased."""
+    def __init__(self, bot):
+        self.journal = bot.Journal('reposts', _apply, Tracked)
+        self.tracked = self.journal.load()
+        pickled = os.path.join(bot.config('main/data_dir'), 'reposts.pickle.gz')
+        if not self.tracked and os.path.exists(pickled):  # from before there was a journal
+            try: saved = bot.pickle_load('reposts')
+            except SerializationError: saved = {}
+            for channel, links in saved.items():
+                for link, entry in links.items():
+                    record = (channel, normalize_link(link), entry)
+                    _apply(self.tracked, record)
+                    self.journal.append(record)
+        for channel in tuple(self.tracked):
+            if tracked_channels is not None and channel not in tracked_channels:
+                del self.tracked[channel]
+
+    def get(self, channel, link):
+        """Returns (poster, datetime, times posted) of link, or None"""
+        return self.tracked[channel.lower()].get(link)
+
+    def set(self, channel, link, entry):
+        channel = channel.lower()
+        self.tracked[channel][link] = entry
+        self.journal.append((channel, link, entry))
+
+    def compact(self):
+        self.journal.compact()
+
+    def close(self):
+        self.journal.close()  # on_load replays it, on_every_1h compacts it
+
+def _hash(link):
+    """Returns a signed 64-bit hash of link, as SQLite stores it"""
+    return int.from_bytes(blake2b(link.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+class BloomFilter(object):
+    """A set of 64-bit hashes that can contain some that were never
+    added (about error_rate of them, with up to capacity added), but
+    surely contains all that were
+
+    >>> bloom = BloomFilter(1000)
+    >>> bloom.add(_hash('example.com'))
+    >>> _hash('example.com') in bloom, _hash('example.org') in bloom
+    (True, False)
+    """
+    def __init__(self, capacity, error_rate=.01):
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _bits(self, hash):
+        # double hashing: the i-th bit is h1 + i*h2, from the hash's two halves
+        h1, h2 = hash & 0xffffffff, (hash >> 32) & 0xffffffff | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, hash):
+        bits = self.bits
+        for i in self._bits(hash): bits[i >> 3] |= 1 << (i & 7)
+
+    def __contains__(self, hash):
+        bits = self.bits
+        for i in self._bits(hash):
+            if not bits[i >> 3] & 1 << (i & 7): return False
+        return True
+
+class SqliteStore(object):
+    """All the links ever posted, in SQLite, by the hash of the link.
+    A BloomFilter of the hashes keeps looking up links never posted
+    before, i.e. most, off the disk. If across_channels, a link counts
+    as a repost in any channel.
+
+    close() saves the filter in the database, for the next load. Without
+    it (e.g. after a crash, or if capacity changed), the filter is
+    rebuilt from all the stored hashes, which takes time in proportion
+    to the number of links (about a second per million).
+    """
+    def __init__(self, path, capacity=1000000, across_channels=False):
+        self.across_channels = across_channels
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')  # no fsync per link, WAL stays consistent
+        self.db.execute('''CREATE TABLE IF NOT EXISTS links (
+                               hash INTEGER NOT NULL,
+                               channel TEXT NOT NULL,  -- '*' across channels
+                               link TEXT NOT NULL,
+                               poster TEXT NOT NULL,
+                               at REAL NOT NULL,  -- unix time
+                               times INTEGER NOT NULL,
+                               PRIMARY KEY (hash, channel, link)) WITHOUT ROWID''')
+        self.db.execute('CREATE TABLE IF NOT EXISTS bloom (count INTEGER, hashes INTEGER, bits BLOB)')
+        saved = self.db.execute('SELECT count, hashes, bits FROM bloom').fetchone()
+        with self.db:
+            self.db.execute('DELETE FROM bloom')  # stale once a link is added
+        self.count = saved[0] if saved else 0  # about how many links are stored
+        self.bloom = BloomFilter(max(capacity, 2 * self.count))
+        if saved and saved[1] == self.bloom.hashes and len(saved[2]) == len(self.bloom.bits):
+            self.bloom.bits[:] = saved[2]
+        else:
+            self.count = 0
+            for hash, in self.db.execute('SELECT hash FROM links'): self.count += 1
+            self.bloom = BloomFilter(max(capacity, 2 * self.count))
+            for hash, in self.db.execute('SELECT hash FROM links'): self.bloom.add(hash)
+
+    def _channel(self, channel):
+        return '*' if self.across_channels else channel.lower()
+
+    def get(self, channel, link):
+        """Returns (poster, datetime, times posted) of link, or None"""
+        hash = _hash(link)
+        if hash not in self.bloom: return None
+        row = self.db.execute('SELECT poster, at, times FROM links WHERE hash = ? AND channel = ? AND link = ?',
+                              (hash, self._channel(channel), link)).fetchone()
+        return row and (row[0], datetime.fromtimestamp(row[1]), row[2])
+
+    def set(self, channel, link, entry):
+        poster, at, times = entry
+        hash = _hash(link)
+        self.count += times == 1
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO links VALUES (?, ?, ?, ?, ?, ?)',
+                            (hash, self._channel(channel), link, poster, time.mktime(at.timetuple()), times))
+        self.bloom.add(hash)
+
+    def import_logs(self, directory):
+        """Adds the links posted in the channels logged (by the logger
+        plugin) under directory; returns how many were posted"""
+        from plugins.logger import read_log, log_files  # only needed here
+        posted = 0
+        for channel in sorted(os.listdir(directory)):
+            path = os.path.join(directory, channel)
+            if not channel.startswith(irc.CHANNEL_PREFIXES) or not os.path.isdir(path): continue
+            if tracked_channels is not None and channel not in tracked_channels: continue
+            rows = []
+            for name in log_files(path):
+                for line in read_log(os.path.join(path, name)):
+                    text = line[20:]
+                    if text.startswith('* '): poster, _, text = text[2:].partition(' ')  # an ACTION
+                    else: poster, _, text = text.partition(': ')
+                    for link in find_links(text):
+                        link = normalize_link(link)
+                        at = time.mktime(time.strptime(line[:19], '%Y-%m-%dT%H:%M:%S'))
+                        rows.append((_hash(link), self._channel(channel), link, poster, at))
+            with self.db:
+                self.db.executemany('INSERT INTO links VALUES (?, ?, ?, ?, ?, 1) '
+                                    'ON CONFLICT (hash, channel, link) DO UPDATE SET times = times + 1', rows)
+            for row in rows: self.bloom.add(row[0])
+            posted += len(rows)
+        self.count += posted
+        return posted
+
+    def compact(self):
+        self.db.execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+    def close(self):
+        with self.db:
+            self.db.execute('INSERT INTO bloom VALUES (?, ?, ?)',
+                            (self.count, self.bloom.hashes, bytes(self.bloom.bits)))
+        self.db.close()
 
 def on_load(bot, _):
-    global tracked, tracked_channels
-    maxlen = int(bot.config.get('reposts/maxlinks', 1000))
-    try: tracked = bot.pickle_load('reposts')
-    except SerializationError:
-        tracked = defaultdict(OrderedDict)
+    global store, tracked_channels
+    LinkHistory.maxlen = int(bot.config.get('reposts/maxlen') or LinkHistory.maxlen)
     tracked_channels = bot.config.get('reposts/channels', None)
     if tracked_channels:
-        tracked_channels = tracked_channels.split(',')
-    _trim_history(tracked, maxlen, tracked_channels)
+        tracked_channels = tracked_channels.lower().split(',')
+    if bot.config.get('reposts/store') == 'sqlite':
+        store = SqliteStore(os.path.join(bot.config('main/data_dir'), 'reposts.sqlite'),
+                            int(bot.config.get('reposts/capacity') or 1000000),
+                            bool(bot.config.get('reposts/across_channels')))
+        logs = bot.config.get('reposts/import_logs')
+        if logs and not store.count:
+            bot.log.info('Importing links from logs in ' + logs)
+            bot.log.info('Imported {} posted links'.format(store.import_logs(logs)))
+    else:
+        store = MemoryStore(bot)
+    on_chanmsg.channels = tracked_channels  # None for all
 
-def on_every_1d(bot, _):
-    _trim(tracked, maxlen, tracked_channels)  # TODO synchronize
+def on_every_1h(bot, _):
+    store.compact()
 
 def on_unload(bot, _):
-    _trim_history(tracked, maxlen, tracked_channels)
-    bot.pickle_dump('reposts', link_tracking)
+    store.close()
 
 link_re = re.compile(r'(((http|https):\/\/|www\.)[\w\-_]+(\.[\w\-_]+)+([\w\-\.,@?!^=%&;:/~\+#]*[\w\-\@?^=%&;/~\+#])?)', flags=re.I)
 
+LINK_STARTS = ('http://', 'https://', 'www.')
+
+def find_links(text):
+    """Returns the links link_re finds in text, faster: it's only tried
+    where one of LINK_STARTS is (as link_re matches only there)
+
+    >>> find_links('xHTTPS://a.b, wwww.c.d/e). http://www.f.g http://h ftp://i.j')
+    ['HTTPS://a.b', 'www.c.d/e', 'http://www.f.g']
+    """
+    lowered = text.lower()
+    if len(lowered) != len(text):  # some characters lowercase to more
+        return [match.group() for match in link_re.finditer(text)]
+    starts = []
+    for start in LINK_STARTS:
+        i = lowered.find(start)
+        while i != -1:
+            starts.append(i)
+            i = lowered.find(start, i + 1)
+    links, end = [], 0
+    for i in sorted(starts):
+        if i < end: continue  # within the previous link
+        match = link_re.match(text, i)
+        if match:
+            links.append(match.group())
+            end = match.end()
+    return links
+
 def on_chanmsg(bot, message):
     channel = message.param[0]
-    if not (channel in tracked_channels or tracked_channels is None): return
-    links = filter(itemgetter(0), link_re.findall(message.text))
+    links = OrderedDict.fromkeys(normalize_link(link) for link in find_links(message.text))
     for link in links:
-        if not link.startswith('http'): link = 'http://' + link
-        poster, at, times = tracked[channel].pop(link, (None, None, 0))
+        poster, at, times = store.get(channel, link) or (None, None, 0)
         if not poster:
             poster, at = message.nick, datetime.now()
         else:
             reposts = REPOSTS if poster != message.nick else SELF_REPOSTS
             bot.privmsg(channel, choice(reposts).format(nick=message.nick, repostNick=poster))
         times += 1
-        tracked[channel][link] = (poster, at, times)
+        store.set(channel, link, (poster, at, times))
+
+# the bot calls on_chanmsg only for messages in these channels, likely with links
+on_chanmsg.channels = None  # set in on_load()
+on_chanmsg.contains = ('://', 'www.')
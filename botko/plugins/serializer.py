@@ -4,9 +4,14 @@ Use pickle-based functions for general serialization, or faster
 marshal-based functions for when you are reliably working with objects
 without recursive references and of only native python types (str, int,
 list, dict, ...).
+
+For state that changes a little at a time, use a Journal: changes are
+appended to it as records, and compacted into a snapshot in the
+background now and then.
 """
 
-import gzip, marshal
+import os, gzip, marshal, struct, zlib
+from threading import Thread
 try: import cPickle as pickle
 except ImportError: import pickle
 
@@ -14,10 +19,12 @@ class SerializationError(Exception): pass
 
 def _gzip(filename, mode, data, serializer, func):
     filename = data_dir + filename + '.' + serializer + '.gz'
+    writing = mode[0][0] == 'w'
     try:
-        with gzip.open(filename, *mode) as f:
+        with gzip.open(filename + '.tmp' if writing else filename, *mode) as f:
             ret_val = func(f, data)
-        return True if mode[0][0] == 'w' else ret_val
+        if writing: os.replace(filename + '.tmp', filename)  # all or nothing
+        return True if writing else ret_val
     except Exception as exc:
         action = 'write' if mode[0][0] == 'w' else 'read'
         bot.log.error('Could not {action} {file}: {exc}'.format(action=action, file=filename, exc=exc))
@@ -39,6 +46,118 @@ def pickle_load(filename):
     return _gzip(filename, ('rb',), None, 'pickle',
                  lambda f, _: pickle.load(f))
 
+class Journal(object):
+    """State kept as a pickled snapshot plus an append-only journal of
+    the records (picklable objects) that changed it since. Each record
+    is applied with apply(state, record), which must be idempotent, as
+    a crash can cause records to be applied twice; new_state() returns
+    the initial state.
+
+    Records are framed with their length and CRC, so a record torn by a
+    crash is detected and dropped when loading. compact() starts a new
+    journal and folds the previous one into the snapshot in a thread.
+
+    >>> import sys, logging, tempfile
+    >>> serializer = sys.modules[Journal.__module__]  # as on_load() sets it up:
+    >>> serializer.data_dir = tempfile.mkdtemp() + os.sep
+    >>> serializer.bot = type('Bot', (), {'log': logging.getLogger()})
+    >>> def apply(state, record): state[record[0]] = record[1]
+    >>> journal = Journal('test', apply, dict)
+    >>> journal.load()
+    {}
+    >>> journal.append(('a', 1)); journal.append(('b', 2)); journal.close()
+    >>> os.truncate(journal.path, os.path.getsize(journal.path) - 1)  # torn by a crash
+    >>> journal = Journal('test', apply, dict)
+    >>> journal.load()
+    {'a': 1}
+    >>> journal.append(('c', 3)); journal.close()
+    >>> journal = Journal('test', apply, dict)
+    >>> sorted(journal.load().items())
+    [('a', 1), ('c', 3)]
+    >>> journal.compact(wait=True); journal.close()
+    >>> sorted(os.listdir(serializer.data_dir))
+    ['test.journal', 'test.snapshot.pickle.gz']
+    >>> sorted(Journal('test', apply, dict).load().items())
+    [('a', 1), ('c', 3)]
+    """
+    HEADER = struct.Struct('<II')  # length, crc32 of the pickled record
+
+    def __init__(self, name, apply, new_state):
+        self.name, self.apply, self.new_state = name, apply, new_state
+        self.path = data_dir + name + '.journal'
+        self.appended = 0  # records since the last compaction
+        self._file = None
+        self._compactor = None
+
+    def _records(self, path, truncate=False):
+        """Yields the records of journal path, up to a torn one, if
+        any, which is truncated if truncate"""
+        try: f = open(path, 'r+b' if truncate else 'rb')
+        except (OSError, IOError): return
+        with f:
+            while True:
+                offset, header = f.tell(), f.read(self.HEADER.size)
+                if not header: return
+                length = crc = None
+                if len(header) == self.HEADER.size:
+                    length, crc = self.HEADER.unpack(header)
+                    data = f.read(length)
+                if length is None or len(data) < length or zlib.crc32(data) != crc:
+                    bot.log.warning('Dropping torn records at {} of {}'.format(offset, path))
+                    if truncate: f.truncate(offset)
+                    return
+                yield pickle.loads(data)
+
+    def _load_snapshot(self):
+        if not os.path.exists(data_dir + self.name + '.snapshot.pickle.gz'):
+            return self.new_state()
+        return pickle_load(self.name + '.snapshot')
+
+    def load(self):
+        """Returns the state of the snapshot and the journals, then
+        opens the journal for appending"""
+        state = self._load_snapshot()
+        for path, truncate in ((self.path + '.old', False), (self.path, True)):
+            for record in self._records(path, truncate):
+                self.apply(state, record)
+                self.appended += truncate
+        self._file = open(self.path, 'ab')
+        return state
+
+    def append(self, record):
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        self._file.write(self.HEADER.pack(len(data), zlib.crc32(data)) + data)
+        self._file.flush()  # to the OS, so it survives the bot crashing
+        self.appended += 1
+
+    def compact(self, wait=False):
+        """Folds the journal into the snapshot, in the background unless
+        wait; does nothing if nothing was appended or still compacting"""
+        if self._compactor is not None and self._compactor.is_alive() or not self.appended:
+            return
+        if not os.path.exists(self.path + '.old'):  # else retry the failed one first
+            self._file.close()
+            os.replace(self.path, self.path + '.old')
+            self._file = open(self.path, 'ab')
+            self.appended = 0
+        self._compactor = Thread(target=self._compact, name='compact ' + self.name)
+        self._compactor.start()
+        if wait: self._compactor.join()
+
+    def _compact(self):
+        try:
+            state = self._load_snapshot()
+            for record in self._records(self.path + '.old'):
+                self.apply(state, record)
+            pickle_dump(self.name + '.snapshot', state)
+            os.remove(self.path + '.old')
+        except Exception as exc:
+            bot.log.error('Could not compact {}: {}'.format(self.path, exc))
+
+    def close(self):
+        if self._compactor is not None: self._compactor.join()
+        if self._file is not None: self._file.close()
+
 def on_load(_bot, _):
     global bot, data_dir
     bot = _bot
@@ -50,3 +169,4 @@ def on_load(_bot, _):
     bot.pickle_dump = pickle_dump
     bot.unserialize = pickle_load
     bot.serialize = pickle_dump
+    bot.Journal = Journal
@@ -0,0 +1,110 @@
+"""Per-plugin handler profiling.
+
+A Profiler times the calls made through its call() and keeps, for each
+'plugin/handler' key: call and error counts, total wall and CPU time,
+and a latency histogram with power-of-two microsecond buckets, from
+which p50/p99 are estimated.
+
+>>> profiler = Profiler()
+>>> profiler.call('example/on_privmsg', sum, (1, 2))
+3
+>>> stats = profiler.report()['example/on_privmsg']
+>>> stats['count'], stats['errors'], stats['p50_ms'] <= stats['max_ms'] * 2
+(1, 0, True)
+"""
+
+import json
+import time
+from threading import Lock
+from functools import partial
+from collections import defaultdict
+
+N_BUCKETS = 32  # bucket i holds latencies under 2**i microseconds; the last, all longer
+
+def handler_key(func, name=None):
+    """Returns 'plugin/name' for a plugin's handler, where name defaults
+    to the function's name
+
+    >>> def on_every_5h(bot, message): pass
+    >>> on_every_5h.__module__ = 'plugins.remarks'
+    >>> handler_key(partial(on_every_5h, None, None))
+    'remarks/on_every_5h'
+    """
+    while isinstance(func, partial): func = func.func
+    module = getattr(func, '__module__', None) or '?'
+    if module.startswith('plugins.'): module = module[len('plugins.'):]
+    return '{}/{}'.format(module, name or getattr(func, '__name__', '?'))
+
+class Stats(object):
+    """Call statistics of one handler"""
+    __slots__ = ('count', 'errors', 'wall', 'cpu', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = self.errors = 0
+        self.wall = self.cpu = self.max = 0.
+        self.buckets = [0] * N_BUCKETS
+
+    def add(self, wall, cpu, error=False):
+        self.count += 1
+        self.errors += error
+        self.wall += wall
+        self.cpu += cpu
+        if wall > self.max: self.max = wall
+        self.buckets[min(int(wall * 1e6).bit_length(), N_BUCKETS - 1)] += 1
+
+    def percentile(self, p):
+        """Returns the upper bound (in seconds) of the histogram bucket
+        holding the p-th percentile latency, but at most the max
+
+        >>> stats = Stats()
+        >>> for ms in (1, 1, 1, 50): stats.add(ms / 1000., 0)
+        >>> stats.percentile(50), stats.percentile(99)
+        (0.001024, 0.05)
+        """
+        rank, seen = p / 100. * self.count, 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n: return min((1 << i) / 1e6, self.max)
+        return self.max
+
+    def asdict(self):
+        return {'count': self.count,
+                'errors': self.errors,
+                'wall_s': round(self.wall, 6),
+                'cpu_s': round(self.cpu, 6),
+                'p50_ms': round(self.percentile(50) * 1e3, 3),
+                'p99_ms': round(self.percentile(99) * 1e3, 3),
+                'max_ms': round(self.max * 1e3, 3)}
+
+class Profiler(object):
+    """Collects Stats per handler key; safe to use from any thread"""
+    def __init__(self):
+        self._lock = Lock()
+        self.stats = defaultdict(Stats)
+        self.started = time.time()
+
+    def call(self, key, func, *args):
+        """Returns func(*args), timing it under key"""
+        wall, cpu = time.perf_counter(), time.thread_time()
+        error = True
+        try:
+            result = func(*args)
+            error = False
+            return result
+        finally:
+            self.record(key, time.perf_counter() - wall, time.thread_time() - cpu, error)
+
+    def record(self, key, wall, cpu, error=False):
+        with self._lock: self.stats[key].add(wall, cpu, error)
+
+    def report(self):
+        """Returns {key: stats dict}, slowest (by total wall time) first"""
+        with self._lock:
+            items = sorted(self.stats.items(), key=lambda item: -item[1].wall)
+            return {key: stats.asdict() for key, stats in items}
+
+    def dump(self, filename):
+        """Writes the report, as JSON, to filename"""
+        with open(filename, 'w') as f:
+            json.dump({'since': self.started, 'until': time.time(),
+                       'handlers': self.report()}, f, indent=1)